@@ -0,0 +1,307 @@
+"""
+asyncio counterparts of the drivers in stage_control.py.
+
+Ports are read through loop.add_reader and written without blocking, so a
+single event loop can drive every device on the rig. Only POSIX serial
+ports are supported.
+
+    async def main():
+        stage = AsyncESP302StageControl(port, 19200, 1)
+        trigger = AsyncTriggerControl(trigger_port, 115200, 1)
+        await open_all(stage, trigger)
+        await stage.send_move_wait(1, 10.0)
+        await trigger.send_trigger(frames=10)
+"""
+
+import asyncio
+import os
+import serial
+import time
+
+import stage_control
+from stage_control import CommandFrame, StageSnapshot
+import wavetables
+from wavetables import Wavetable
+
+
+async def open_all(*devices) -> None:
+    await asyncio.gather(*(device.open() for device in devices))
+
+
+class AsyncSerialDevice:
+    _TERMINATOR = b"\n"
+
+    def __init__(self, serial_name: str, serial_baud: int, timeout: int):
+        # The port itself never blocks; timeouts are applied with asyncio instead
+        self._serial = serial.Serial(serial_name, serial_baud, timeout=0)
+        self.timeout = timeout
+        self._buffer = bytearray()
+        self._lines = asyncio.Queue()
+        self._query_mutex = asyncio.Lock()
+        self._write_mutex = asyncio.Lock()
+        self._loop = None
+
+    async def open(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._serial.fileno(), self._on_readable)
+
+    def close(self) -> None:
+        if self._loop is not None:
+            self._loop.remove_reader(self._serial.fileno())
+            self._loop = None
+        self._serial.close()
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self._serial.fileno(), 4096)
+        except BlockingIOError:
+            return
+        if len(data) == 0:
+            # EOF, e.g. the device was unplugged; stop watching the fd or the
+            # loop would call us back forever
+            print(f"{self._serial.name} disconnected")
+            self._loop.remove_reader(self._serial.fileno())
+            return
+        self._buffer += data
+        while True:
+            i = self._buffer.find(self._TERMINATOR)
+            if i < 0:
+                break
+            end = i + len(self._TERMINATOR)
+            self._lines.put_nowait(bytes(self._buffer[:end]))
+            del self._buffer[:end]
+
+    async def _wait_writable(self) -> None:
+        fd = self._serial.fileno()
+        writable = self._loop.create_future()
+        self._loop.add_writer(fd, writable.set_result, None)
+        try:
+            await writable
+        finally:
+            self._loop.remove_writer(fd)
+
+    async def _write(self, payload) -> int:
+        view = memoryview(payload)
+        async with self._write_mutex:
+            while len(view) > 0:
+                try:
+                    n = os.write(self._serial.fileno(), view)
+                except BlockingIOError:
+                    n = 0
+                view = view[n:]
+                if len(view) > 0:
+                    await self._wait_writable()
+        return len(payload)
+
+    async def readline(self, timeout: float = None) -> bytes:
+        """Return the next reply line, stripped; b"" on timeout."""
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            line = await asyncio.wait_for(self._lines.get(), timeout)
+        except asyncio.TimeoutError:
+            return b""
+        return line.strip()
+
+    def _discard_stale(self) -> None:
+        # Replies which arrived after their query timed out
+        while not self._lines.empty():
+            self._lines.get_nowait()
+
+    async def _query_line(self, payload: bytes) -> bytes:
+        async with self._query_mutex:
+            self._discard_stale()
+            await self._write(payload)
+            return await self.readline()
+
+    async def _wait_done(self, payload: bytes):
+        # The Picos reply D once they are done, which may take any length of time
+        async with self._query_mutex:
+            self._discard_stale()
+            sent = await self._write(payload)
+            while True:
+                rv = await self.readline()
+                if len(rv) > 0:
+                    return sent, rv == b"D"
+
+
+class AsyncESPStageControl(AsyncSerialDevice):
+    _HOME_ALL_AXIS = None
+    _AXES = (1, 2, 3)
+
+    def __init__(self, serial_name: str, serial_baud: int, timeout: int):
+        AsyncSerialDevice.__init__(self, serial_name, serial_baud, timeout)
+        self._targets = {}
+        self._velocities = {}
+
+    def frame(self) -> CommandFrame:
+        """Send frames with `await frame.send()` or `async with stage.frame()`."""
+        return CommandFrame(self)
+
+    async def send_frame(self, frame: CommandFrame) -> None:
+        if len(frame) == 0:
+            return
+        # Only the write lock is taken, so stops never wait behind a pending reply
+        commands = list(frame.commands)
+        payload = b"".join(stage_control.encode_command(*c) for c in commands)
+        await self._write(payload)
+        stage_control.track_commands(commands, self._targets, self._velocities)
+
+    async def home(self, axis: int) -> None:
+        await self.frame().home(axis).send()
+
+    async def home_all(self) -> None:
+        await self.frame().home(self._HOME_ALL_AXIS).send()
+
+    async def query(self, queries: list) -> list:
+        cmd = ";".join(queries) + "\n"
+        rv = await self._query_line(bytes(cmd, "utf-8"))
+        return stage_control.split_reply(rv)
+
+    async def query_status(
+        self, axes: tuple = None, errors: bool = False
+    ) -> StageSnapshot:
+        axes = self._AXES if axes is None else tuple(axes)
+        rv = await self.query(stage_control.status_queries(axes, errors))
+        return stage_control.parse_status(axes, rv, errors)
+
+    async def get_current_position(self) -> dict:
+        rv = (await self._query_line(b"TP\n")).split(b",")
+        return {i + 1: float(x) for i, x in enumerate(rv)}
+
+    async def get_is_moving(self) -> dict:
+        return stage_control.parse_moving(await self._query_line(b"TS\n"))
+
+    async def is_moving(self) -> bool:
+        return any((await self.get_is_moving()).values())
+
+    async def emergency_stop(self, axis: int = None) -> None:
+        await self.frame().abort().send()
+
+    async def stop(self, axis: int) -> None:
+        await self.frame().stop(axis).send()
+
+    async def wait_for_move(
+        self,
+        axis: int = None,
+        timeout: float = None,
+        min_interval: float = 0.005,
+        max_interval: float = 0.25,
+    ) -> None:
+        """Same polling strategy as ESPStageControl.wait_for_move, without blocking."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = min_interval
+        while True:
+            snapshot = await self.query_status()
+            axes = [
+                a for a, m in snapshot.axes_moving.items() if m and axis in (None, a)
+            ]
+            if not axes:
+                return
+
+            remaining = stage_control.estimate_remaining(
+                axes, snapshot.position, self._targets, self._velocities
+            )
+            interval = stage_control.poll_interval(
+                interval, remaining, min_interval, max_interval
+            )
+            if deadline is not None:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise TimeoutError(f"Stage still moving on axes {axes}")
+                interval = min(interval, deadline - now)
+            await asyncio.sleep(interval)
+
+    async def send_move(self, axis: int, position: float) -> None:
+        await self.frame().stop(axis).wait(50).move(axis, position).send()
+
+    async def send_velocity(self, axis: int, velocity: float) -> None:
+        await self.frame().velocity(axis, velocity).send()
+
+    async def send_move_indefinite(self, axis: int, dir: str) -> None:
+        await self.frame().move_indefinite(axis, dir).send()
+
+    async def send_jog(self, axis: int, velocity: float, dir: str) -> None:
+        if not ((dir == "+") or (dir == "-")):
+            return
+        await self.frame().velocity(axis, velocity).move_indefinite(axis, dir).send()
+
+    async def send_move_wait(
+        self, axis: int, position: float, timeout: float = None
+    ) -> None:
+        await self.send_move(axis, position)
+        await self.wait_for_move(timeout=timeout)
+
+    async def send_enable_axis(self, axis: int) -> None:
+        await self.frame().enable_axis(axis).send()
+
+    async def status(self) -> dict:
+        rv = await self.query_status(errors=True)
+        return {
+            "position": rv.position,
+            "axes_moving": rv.axes_moving,
+            "stage_active_flag": any(rv.axes_moving.values()),
+            "error": (rv.error_code, rv.error_message),
+        }
+
+
+class AsyncESP302StageControl(AsyncESPStageControl):
+    _HOME_ALL_AXIS = None
+
+
+class AsyncESP300StageControl(AsyncESPStageControl):
+    _HOME_ALL_AXIS = 0
+
+
+class AsyncTriggerControl(AsyncSerialDevice):
+    async def send_trigger(self, channel=None, frames=1000, stage=True, notify=False):
+        payload = stage_control.TriggerControl.encode_trigger(
+            channel, frames, stage, notify
+        )
+        _, done = await self._wait_done(payload)
+        return done
+
+
+class AsyncDACControl(AsyncSerialDevice):
+    def __init__(
+        self, serial_name: str, serial_baud: int, timeout: int, default_table=""
+    ):
+        AsyncSerialDevice.__init__(self, serial_name, serial_baud, timeout)
+        self.default_table = default_table
+        self.DAC_table = Wavetable((), byte_depth=2, key=b"S")
+        self.AOTF_table = Wavetable((), byte_depth=1, key=b"A")
+
+    load_table = staticmethod(stage_control.DACControl.load_table)
+
+    async def send_table(self, wavetable, key=b"S", byte_depth=2):
+        payload = stage_control.DACControl.encode_table(wavetable, key, byte_depth)
+        sent, done = await self._wait_done(payload)
+        print(f"Sent {sent} bytes")
+        return done
+
+    async def send_wavetable(self):
+        return await self.send_table(self.DAC_table, key=b"S", byte_depth=2)
+
+    async def send_AOTF_table(self):
+        return await self.send_table(self.AOTF_table, key=b"A", byte_depth=1)
+
+    async def reset(self):
+        await self._wait_done(b"R")
+        return True
+
+    async def load_defaults(self):
+        print("Performing reset...")
+        await self.reset()
+
+        print(f"Loading DAC table from file... [{self.default_table}]")
+        self.DAC_table = wavetables.load_file(self.default_table, 2, b"S")
+
+        print("Applying DAC function...")
+        start = time.time()
+        rv = await self.send_wavetable()
+        print(f"\tFinished in {(time.time() - start)}s [{rv}]")
+
+        print("Applying AOTF function...")
+        start = time.time()
+        self.AOTF_table = stage_control.DEFAULT_AOTF_TABLE
+        rv = await self.send_AOTF_table()
+        print(f"\tFinished in {time.time() - start} [{rv}]")
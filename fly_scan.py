@@ -0,0 +1,186 @@
+"""
+Fly scans: triggers issued while the stage moves at constant velocity.
+
+The axis backs up by a run-up distance so it is at full speed when it
+reaches the first trigger position. It is then sent to the far end of the
+strip at the scan velocity. Triggers go out at the times the stage is
+predicted to pass each position, or, with by_position=True, when a polled
+position passes it. Each trigger is logged with the position read back
+straight after it was written to the port.
+"""
+
+import math
+import threading
+import time
+from concurrent.futures import Future
+
+import motion_model
+
+
+def trigger_positions(start: float, stop: float, spacing: float) -> list:
+    if spacing == 0:
+        raise ValueError("Fly-scan spacing must be non-zero")
+    spacing = abs(spacing) if stop >= start else -abs(spacing)
+    count = int(math.floor((stop - start) / spacing + 1e-9)) + 1
+    return [start + i * spacing for i in range(count)]
+
+
+def time_to_reach(
+    distance: float, velocity: float, acceleration: float = None
+) -> float:
+    """Time from rest to cover distance with a velocity limit (no settle)."""
+    distance = abs(distance)
+    if acceleration is None:
+        return distance / velocity
+    ramp = velocity * velocity / (2 * acceleration)
+    if distance < ramp:
+        return math.sqrt(2 * distance / acceleration)
+    return distance / velocity + velocity / (2 * acceleration)
+
+
+class FlyScanJob(threading.Thread):
+    def __init__(
+        self,
+        stage,
+        axis: int,
+        trigger,
+        start: float,
+        stop: float,
+        velocity: float,
+        spacing: float,
+        frames: int = 1,
+        channel=None,
+        run_up: float = None,
+        by_position: bool = False,
+        move_timeout: float = 30.0,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.stage = stage
+        self.axis = axis
+        self.trigger = trigger
+        self.velocity = abs(velocity)
+        self.positions = trigger_positions(start, stop, spacing)
+        self.direction = 1 if stop >= start else -1
+        self.frames = frames
+        self.channel = channel
+        self.by_position = by_position
+        self.move_timeout = move_timeout
+
+        # Filled in from the motion model (or AC?) when the job starts
+        self.acceleration = None
+        self.run_up = run_up
+
+        self.state = "pending"
+        self.error = None
+        self.log = []
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def report(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "triggers_done": len(self.log),
+            "triggers_total": len(self.positions),
+            "run_up": self.run_up,
+            "log": list(self.log),
+        }
+
+    def _setup_run_up(self) -> None:
+        model = self.stage.motion_models.get(self.axis)
+        if model is None:
+            model = motion_model.read_motion_model(self.stage, self.axis)
+        self.acceleration = model.acceleration
+        if self.run_up is None:
+            # Distance needed to reach the scan velocity, with some margin
+            self.run_up = 1.5 * self.velocity**2 / (2 * self.acceleration)
+
+    def _fire(self, i: int, position: float, t_start: float) -> None:
+        # The trigger may wait behind other jobs on its I/O thread, so time it
+        # from when it is actually written rather than when it is queued
+        written = Future()
+        self.trigger.send_trigger(
+            channel=self.channel,
+            frames=self.frames,
+            stage=False,
+            wait=False,
+            on_sent=written.set_result,
+        )
+        t_trigger = written.result(self.move_timeout)
+        actual = self.stage.get_current_position()[self.axis]
+        t_read = time.monotonic()
+        self.log.append(
+            {
+                "trigger": i,
+                "target": position,
+                "position": actual,
+                # Back out the distance travelled while the position was being read
+                "position_at_trigger": actual
+                - self.direction * self.velocity * (t_read - t_trigger) / 2,
+                "time": t_trigger - t_start,
+            }
+        )
+
+    def _wait_until_passed(self, position: float, deadline: float) -> bool:
+        """Poll until the axis passes position; False if cancelled."""
+        while True:
+            if self._cancel.is_set():
+                return False
+            snapshot = self.stage.query_status(axes=(self.axis,))
+            if (snapshot.position[self.axis] - position) * self.direction >= 0:
+                return True
+            if not snapshot.axes_moving[self.axis]:
+                raise RuntimeError(
+                    f"Axis {self.axis} stopped at {snapshot.position[self.axis]} "
+                    f"before reaching trigger position {position}"
+                )
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Axis {self.axis} did not reach {position}")
+
+    def run(self):
+        self.state = "running"
+        previous_velocity = self.stage._velocities.get(self.axis)
+        try:
+            self._setup_run_up()
+            origin = self.positions[0] - self.direction * self.run_up
+            end = self.positions[-1] + self.direction * self.run_up
+
+            self.stage.send_move(self.axis, origin)
+            self.stage.wait_for_axis(self.axis, timeout=self.move_timeout)
+
+            with self.stage.frame() as f:
+                f.velocity(self.axis, self.velocity).move(self.axis, end)
+            t_start = time.monotonic()
+
+            for i, position in enumerate(self.positions):
+                if self._cancel.is_set():
+                    self.stage.stop(self.axis)
+                    self.state = "cancelled"
+                    return
+
+                due = t_start + time_to_reach(
+                    position - origin, self.velocity, self.acceleration
+                )
+                if self.by_position:
+                    # Each check is a status round trip, so this doesn't spin
+                    if not self._wait_until_passed(position, due + self.move_timeout):
+                        self.stage.stop(self.axis)
+                        self.state = "cancelled"
+                        return
+                else:
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self._fire(i, position, t_start)
+
+            self.stage.wait_for_axis(self.axis, timeout=self.move_timeout)
+            self.state = "done"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+            self.stage.stop(self.axis)
+        finally:
+            if previous_velocity is not None:
+                self.stage.send_velocity(self.axis, previous_velocity)
@@ -0,0 +1,81 @@
+import threading
+import time
+
+
+class JogDispatcher(threading.Thread):
+    """Forwards jog velocities to the stages at a fixed rate, latest value wins.
+
+    The gamepad loop calls set_velocity for every axis event. Targets are
+    only written to the stage on the next tick, so intermediate values from
+    a fast-moving stick are dropped instead of queueing up on the serial
+    link. Stops bypass the tick and go out immediately.
+    """
+
+    def __init__(self, rate: float = 50.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = 1.0 / rate
+        self._targets = {}  # (stage, axis) -> signed velocity
+        self._sent = {}
+        self._mutex = threading.Lock()
+        self._stop_event = threading.Event()
+        self.sent_count = 0
+        self.dropped_count = 0
+
+    def set_velocity(self, stage, axis: int, velocity: float) -> None:
+        if velocity == 0:
+            self.stop(stage, axis)
+            return
+        with self._mutex:
+            key = (stage, axis)
+            if self._targets.get(key, 0) != self._sent.get(key, 0):
+                self.dropped_count += 1
+            self._targets[key] = velocity
+
+    def stop(self, stage, axis: int) -> None:
+        with self._mutex:
+            key = (stage, axis)
+            if self._targets.get(key, 0) == 0 and self._sent.get(key, 0) == 0:
+                return  # already stopped, don't repeat it for every deadzone event
+            self._targets[key] = 0
+            self._sent[key] = 0
+        # Not under the mutex, so a stop never waits for a flush. A flush
+        # frame built before this point is dropped by the stage once the
+        # stop has gone out (see CommandFrame.stops).
+        stage.stop(axis)
+
+    def cancel(self) -> None:
+        """Drop all pending targets, for when the caller stops the stages itself."""
+        with self._mutex:
+            for key in self._targets:
+                self._targets[key] = 0
+                self._sent[key] = 0
+
+    def flush(self) -> None:
+        frames = {}
+        with self._mutex:
+            for (stage, axis), velocity in self._targets.items():
+                if velocity == self._sent.get((stage, axis), 0):
+                    continue
+                if stage not in frames:
+                    frames[stage] = stage.frame()
+                direction = "+" if velocity > 0 else "-"
+                frames[stage].velocity(axis, abs(velocity))
+                frames[stage].move_indefinite(axis, direction)
+                self._sent[(stage, axis)] = velocity
+                self.sent_count += 1
+
+        for frame in frames.values():
+            frame.send()
+
+    def close(self) -> None:
+        self._stop_event.set()
+
+    def run(self):
+        next_flush = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Jog flush failed: {e}")
+            next_flush = max(next_flush + self.interval, time.monotonic())
+            self._stop_event.wait(next_flush - time.monotonic())
@@ -0,0 +1,75 @@
+"""
+Kinematic move-time model for the ESP stage axes.
+
+Each axis is modelled by a trapezoidal velocity profile plus a fixed settle
+time. The settle time also covers command and polling overhead. Velocity
+and acceleration are read back from the controller, and the settle time is
+calibrated from timed moves.
+"""
+
+import math
+import statistics
+import time
+from dataclasses import dataclass, asdict
+
+
+@dataclass
+class AxisMotionModel:
+    velocity: float
+    acceleration: float
+    settle: float = 0.0
+
+    def move_time(self, distance: float, velocity: float = None) -> float:
+        """Seconds from the PA being sent until the axis reports stopped."""
+        distance = abs(distance)
+        if distance == 0:
+            return 0.0
+        velocity = self.velocity if velocity is None else velocity
+        ramp = velocity * velocity / self.acceleration
+        if distance < ramp:
+            # Too short to reach full speed: triangular profile
+            profile = 2 * math.sqrt(distance / self.acceleration)
+        else:
+            profile = distance / velocity + velocity / self.acceleration
+        return profile + self.settle
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "AxisMotionModel":
+        return cls(**d)
+
+
+def read_motion_model(stage, axis: int) -> AxisMotionModel:
+    velocity, acceleration = stage.query([f"{axis}VA?", f"{axis}AC?"])
+    return AxisMotionModel(float(velocity), float(acceleration))
+
+
+def calibrate(
+    stage, axis: int, distances=(0.1, 1.0, 5.0), repeats: int = 2, timeout=30.0
+) -> AxisMotionModel:
+    """Fit the settle time of an axis from timed out-and-back moves.
+
+    The axis is left where it started. Call set_motion_model on the stage to
+    use the result.
+    """
+    model = read_motion_model(stage, axis)
+    origin = stage.get_current_position()[axis]
+    position = origin
+
+    overheads = []
+    for distance in distances:
+        for _ in range(repeats):
+            for target in (origin + distance, origin):
+                stage.frame().move(axis, target).send()
+                start = time.monotonic()
+                stage.wait_for_axis(
+                    axis, timeout, predict=False, min_interval=0.001, max_interval=0.005
+                )
+                elapsed = time.monotonic() - start
+                overheads.append(elapsed - model.move_time(target - position))
+                position = target
+
+    model.settle = max(0.0, statistics.median(overheads))
+    return model
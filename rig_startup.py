@@ -0,0 +1,114 @@
+"""
+Parallel rig startup.
+
+Every device is opened and initialised as one job on a thread pool, so the
+stages, trigger controller and DACs come up at the same time. Each job
+returns a Future for its device, and the caller waits only for what it
+needs next: for example the API can start once the stages are up while
+the DAC tables are still loading. Every step is timed, and the breakdown
+is printed once all devices are done.
+
+    startup = RigStartup()
+    stage = startup.add("stage", lambda: ESP302StageControl(port, 19200, 1))
+    dac = startup.add("DAC 488", lambda: DACControl(...), DACControl.load_defaults)
+    stage = stage.result()
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+
+class DeviceStartup:
+    def __init__(self, name: str):
+        self.name = name
+        self.timings = {}
+        self.error = None
+        self.start = None
+        self.end = None
+
+    def _step(self, label: str, fn, *args):
+        t0 = time.monotonic()
+        try:
+            rv = fn(*args)
+        finally:
+            self.timings[label] = time.monotonic() - t0
+        if isinstance(rv, dict):
+            # Steps may report a breakdown of their own, e.g. load_defaults
+            for k, v in rv.items():
+                self.timings[f"{label}.{k}"] = v
+        return rv
+
+
+class RigStartup:
+    def __init__(self, max_workers: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="startup")
+        self._t0 = time.monotonic()
+        self.devices = {}
+        self.futures = {}
+
+    def _run(self, device: DeviceStartup, factory, steps):
+        device.start = time.monotonic()
+        try:
+            handle = device._step("open", factory)
+            for step in steps:
+                label, fn = step if isinstance(step, tuple) else (step.__name__, step)
+                device._step(label, fn, handle)
+            return handle
+        except Exception as e:
+            device.error = str(e)
+            raise
+        finally:
+            device.end = time.monotonic()
+
+    def add(self, name: str, factory, *steps) -> Future:
+        """Open a device with factory() and run steps on it, in order.
+
+        A step is fn(handle) or a (label, fn) pair. The Future resolves to
+        the handle once every step has finished.
+        """
+        device = DeviceStartup(name)
+        self.devices[name] = device
+        self.futures[name] = self._executor.submit(self._run, device, factory, steps)
+        return self.futures[name]
+
+    def wait(self, timeout: float = None) -> bool:
+        done, pending = wait(list(self.futures.values()), timeout)
+        return len(pending) == 0
+
+    def report(self) -> dict:
+        return {
+            name: {
+                "start": None if d.start is None else d.start - self._t0,
+                "end": None if d.end is None else d.end - self._t0,
+                "error": d.error,
+                "timings": dict(d.timings),
+            }
+            for name, d in self.devices.items()
+        }
+
+    def print_report(self) -> None:
+        print("Startup timing:")
+        for name, d in self.devices.items():
+            if d.end is None:
+                print(f"\t{name}: still running")
+                continue
+            steps = ", ".join(f"{k} {v:.2f}s" for k, v in d.timings.items())
+            status = f"FAILED ({d.error})" if d.error is not None else "ok"
+            print(
+                f"\t{name}: {status} at {d.end - self._t0:.2f}s "
+                f"[{d.end - d.start:.2f}s: {steps}]"
+            )
+        ends = [d.end for d in self.devices.values() if d.end is not None]
+        if ends:
+            print(f"\tAll devices up after {max(ends) - self._t0:.2f}s")
+
+    def print_report_when_done(self) -> None:
+        """Print the breakdown from a background thread once every job ends."""
+
+        def report():
+            self.wait()
+            self.print_report()
+            self._executor.shutdown(wait=False)
+
+        threading.Thread(target=report, name="startup report", daemon=True).start()
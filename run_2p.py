@@ -1,5 +1,6 @@
 import stage_control
 import Gamepad
+import jog_dispatcher
 import time
 
 import flask
@@ -8,11 +9,23 @@ import threading
 ###################################################
 # DEFINE STAGE VARIABLES
 ###################################################
+threaded_io = True  # give every serial device its own I/O thread
+
 stages = [
     stage_control.ESP300StageControl(
-        "/dev/serial/by-path/pci-0000:00:14.0-usb-0:1.3:1.0-port0", 19200, 1
+        "/dev/serial/by-path/pci-0000:00:14.0-usb-0:1.3:1.0-port0",
+        19200,
+        1,
+        threaded=threaded_io,
     ),
 ]
+
+status_poll_rate = 10  # Hz
+query_pipeline_depth = 4
+
+for stage in stages:
+    stage.start_pipeline(query_pipeline_depth)
+    stage.start_poller(status_poll_rate)
 ###################################################
 
 ###################################################
@@ -29,6 +42,10 @@ right_velocity_scale = 100
 z_velocity_max = 0.4
 
 gamepad_disable = False
+
+jog_rate = 50  # Hz
+jog = jog_dispatcher.JogDispatcher(jog_rate)
+jog.start()
 ###################################################
 
 ###################################################
@@ -66,6 +83,28 @@ def move(ax, loc):
     return "Done."
 
 
+@flask_app.route("/move_channels")
+def move_channels():
+    # EX: /move_channels?1=10.5&3=2.0&timeout=30&tolerance=0.001
+    args = flask.request.args.to_dict()
+    try:
+        timeout = float(args.pop("timeout")) if "timeout" in args else None
+        tolerance = float(args.pop("tolerance", 1e-3))
+        targets = {(int(k) if k.isdigit() else k): float(v) for k, v in args.items()}
+        return stage_control.coordinated_move(
+            channel_map, targets, timeout=timeout, tolerance=tolerance
+        )
+    except TimeoutError as e:
+        return {"error": str(e)}, 504
+    except KeyError as e:
+        return {"error": f"Unknown channel {e}"}, 400
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except RuntimeError as e:
+        # A channel stopped short of its target, e.g. on a limit or an abort
+        return {"error": str(e)}, 500
+
+
 @flask_app.route("/velocity/<ax>/<speed>")
 def velocity(ax, speed):
     ax, speed = int(ax), float(speed)
@@ -73,25 +112,74 @@ def velocity(ax, speed):
     return "Done."
 
 
+def get_snapshots():
+    # ?fresh=1 forces a synchronous query instead of the cached poller state
+    fresh = flask.request.args.get("fresh", "0") == "1"
+    snapshots = {}
+    for s, c in channel_map.values():
+        if id(s) not in snapshots:
+            snapshots[id(s)] = s.get_snapshot(fresh=fresh)
+    return snapshots
+
+
 @flask_app.route("/is_moving")
 def is_moving():
-    return {"is_moving": any(s.get_is_moving()[c] for s, c in channel_map.values())}
+    snapshots = get_snapshots()
+    return {
+        "is_moving": any(
+            snapshots[id(s)].axes_moving[c] for s, c in channel_map.values()
+        )
+    }
 
 
 @flask_app.route("/get_is_moving")
 def get_moving():
-    return {cid: s.get_is_moving()[c] for cid, (s, c) in channel_map.items()}
+    snapshots = get_snapshots()
+    return {cid: snapshots[id(s)].axes_moving[c] for cid, (s, c) in channel_map.items()}
 
 
 @flask_app.route("/get_positions")
 def get_positions():
-    return {cid: s.get_current_position()[c] for cid, (s, c) in channel_map.items()}
+    snapshots = get_snapshots()
+    return {cid: snapshots[id(s)].position[c] for cid, (s, c) in channel_map.items()}
+
+
+@flask_app.route("/get_status")
+def get_status():
+    snapshots = get_snapshots()
+    return {
+        cid: {
+            "position": snapshots[id(s)].position[c],
+            "is_moving": snapshots[id(s)].axes_moving[c],
+            "timestamp": snapshots[id(s)].timestamp,
+        }
+        for cid, (s, c) in channel_map.items()
+    }
+
+
+@flask_app.route("/wait_for_move")
+def wait_for_move():
+    timeout = flask.request.args.get("timeout", type=float)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        for stage in stages:
+            stage.wait_for_move(deadline=deadline)
+    except TimeoutError:
+        return {"is_moving": True}
+    return {"is_moving": False}
+
+
+@flask_app.route("/io_stats")
+def io_stats():
+    return {
+        "stages": {i: s.io_stats() for i, s in enumerate(stages)},
+        "stop_latency": {i: s.stop_stats() for i, s in enumerate(stages)},
+    }
 
 
 @flask_app.route("/emergency_stop")
 def emergency_stop():
-    for stage in stages:
-        stage.emergency_stop()
+    stage_control.emergency_stop_all(stages)
     return "Done."
 
 
@@ -125,38 +213,33 @@ while True:
                 # 6 == dpad horizontal; 7 == dpad vertical
                 ax, i = channel_map["Z"]
                 if abs(value) < deadzone:  # eps
-                    ax.stop(i)
+                    jog.stop(ax, i)
                 else:
                     value *= -1 if (control == 7) else 1
-                    direction = "+" if value > 0 else "-"
                     velocity = (
                         z_velocity_max if (control == 6) else (z_velocity_max / 10)
                     )
+                    velocity *= 1 if value > 0 else -1
 
-                    ax.send_velocity(i, velocity)
-                    ax.send_move_indefinite(i, direction)
+                    jog.set_velocity(ax, i, velocity)
             elif control == "LT":
                 pass
             elif control == "RT":
                 pass
             elif control.startswith("RIGHT-") or control.startswith("LEFT-"):
                 is_left = control.startswith("LEFT")
-                ax = control.split('-')[1]
-                ax = right_channel_map[ax]
-                ax, i = channel_map[ax]
+                stick = control.split('-')[1]
+                ax, i = channel_map[right_channel_map[stick]]
 
                 if abs(value) < deadzone:
-                    stages[0].stop(ax)
+                    jog.stop(ax, i)
                     # print("Stopping Axis")
                 else:
                     value *= right_velocity_scale * right_velocity_max / 100.0
                     value *= 0.04 if is_left else 1.0
-                    value *= -1 if right_invert[ax] else 1
+                    value *= -1 if right_invert[stick] else 1
 
-                    direction = "+" if (value > 0) else "-"
-
-                    stages[0].send_velocity(ax, abs(value))
-                    stages[0].send_move_indefinite(ax, direction)
+                    jog.set_velocity(ax, i, value)
                     # print("New Velocity:", velocity)
             else:
                 print(eventType, control, value)
@@ -168,8 +251,10 @@ while True:
                         for ax, i in channel_map.values():
                             ax.send_enable_axis(i)
                     case "X":
-                        for ax, i in channel_map.values():
-                            ax.stop(i)
+                        jog.cancel()
+                        with stages[0].frame() as f:
+                            for ax, i in channel_map.values():
+                                f.stop(i)
                     case "B":
                         right_velocity_scale -= 20
                         if right_velocity_scale == 0:
@@ -178,16 +263,16 @@ while True:
                     case "A":
                         pass
                     case "RB":
+                        jog.cancel()
                         ax, i = channel_map["Z"]
-                        ax.stop(i)
-                        ax.send_velocity(i, z_velocity_max)
-                        ax.home(i)
+                        with ax.frame() as f:
+                            f.stop(i).velocity(i, z_velocity_max).home(i)
                     case "LB":
-                        for c in ["X", "Y"]:
-                            ax, i = channel_map[c]
-                            ax.stop(i)
-                            ax.send_velocity(i, right_velocity_max)
-                            ax.home(i)
+                        jog.cancel()
+                        with stages[0].frame() as f:
+                            for c in ["X", "Y"]:
+                                ax, i = channel_map[c]
+                                f.stop(i).velocity(i, right_velocity_max).home(i)
                     case "START":
                         pass
             else:
@@ -1,20 +1,51 @@
 import stage_control
 import Gamepad
+import fly_scan
+import jog_dispatcher
+import motion_model
+import rig_startup
+import tile_scan
+import wavetable_gen
+import wavetables
+import zstack
 import time
 
 import flask
+import functools
 import threading
 
 ###################################################
 # DEFINE STAGE VARIABLES
 ###################################################
-stages = [
-    stage_control.ESP302StageControl(
-        "/dev/serial/by-path/pci-0000:00:14.0-usb-0:1.3:1.0-port0", 19200, 1
-    ),
-    stage_control.ESP302StageControl(
-        "/dev/serial/by-path/pci-0000:00:14.0-usb-0:1.2:1.0-port0", 19200, 1
-    ),
+threaded_io = True  # give every serial device its own I/O thread
+
+# Devices are opened and initialised in parallel. The API comes up once the
+# stages and trigger are ready; the DACs keep loading in the background.
+startup = rig_startup.RigStartup()
+
+stage_devs = [
+    "/dev/serial/by-path/pci-0000:00:14.0-usb-0:1.3:1.0-port0",
+    "/dev/serial/by-path/pci-0000:00:14.0-usb-0:1.2:1.0-port0",
+]
+
+status_poll_rate = 10  # Hz
+query_pipeline_depth = 4
+
+
+def start_stage_threads(stage):
+    stage.start_pipeline(query_pipeline_depth)
+    stage.start_poller(status_poll_rate)
+
+
+stage_jobs = [
+    startup.add(
+        f"stage {i}",
+        functools.partial(
+            stage_control.ESP302StageControl, dev, 19200, 1, threaded=threaded_io
+        ),
+        start_stage_threads,
+    )
+    for i, dev in enumerate(stage_devs)
 ]
 ###################################################
 
@@ -22,7 +53,12 @@ stages = [
 # DEFINE STAGE VARIABLES
 ###################################################
 controller_dev = "/dev/serial/by-id/usb-Raspberry_Pi_Pico_E660D4A0A79A5125-if00"
-controller_handle = stage_control.TriggerControl(controller_dev, 115200, 1)
+controller_job = startup.add(
+    "trigger",
+    functools.partial(
+        stage_control.TriggerControl, controller_dev, 115200, 1, threaded=threaded_io
+    ),
+)
 ###################################################
 
 ###################################################
@@ -40,13 +76,47 @@ DAC_tables = {
     642: "galvo_tables/642.txt",
 }
 
-DAC_handles = {
-    k: stage_control.DACControl(v, 115200, 1, DAC_tables[k])
+# The upload cache can't tell that a Pico was power-cycled and is back on
+# its firmware defaults. Set this after a power cycle to reload the tables.
+dac_force_upload = False
+
+DAC_jobs = {
+    k: startup.add(
+        f"DAC {k}",
+        functools.partial(
+            stage_control.DACControl, v, 115200, 1, DAC_tables[k], threaded=threaded_io
+        ),
+        (
+            "load_defaults",
+            functools.partial(
+                stage_control.DACControl.load_defaults, force=dac_force_upload
+            ),
+        ),
+    )
     for k, v in DAC_devs.items()
 }
 
-for k, v in DAC_handles.items():
-    v.load_defaults()
+DAC_handles = {}  # filled in as each DAC finishes loading
+
+
+def dac_ready(k, job):
+    if job.exception() is None:
+        DAC_handles[k] = job.result()
+
+
+for k, job in DAC_jobs.items():
+    job.add_done_callback(functools.partial(dac_ready, k))
+
+
+def get_dac(k):
+    """DAC handle, waiting for it to finish starting up if it hasn't yet."""
+    return DAC_jobs[k].result()
+
+
+startup.print_report_when_done()
+
+stages = [job.result() for job in stage_jobs]
+controller_handle = controller_job.result()
 ###################################################
 
 ###################################################
@@ -63,6 +133,10 @@ right_velocity_scale = 100
 z_velocity_max = 0.4
 
 gamepad_disable = False
+
+jog_rate = 50  # Hz
+jog = jog_dispatcher.JogDispatcher(jog_rate)
+jog.start()
 ###################################################
 
 ###################################################
@@ -122,6 +196,146 @@ def trigger_expanded(channel, frames, stage, notify):
     return "Done."
 
 
+zstack_job = None
+
+
+@flask_app.route("/zstack/start/<start>/<stop>/<step>/<frames>/<channel>")
+def zstack_start(start, stop, step, frames, channel):
+    global zstack_job
+    if zstack_job is not None and zstack_job.is_alive():
+        return {"error": "A z-stack is already running"}, 409
+
+    channel = None if channel.startswith("A") else int(channel)
+    stage, axis = channel_map[axis_map["z"]]
+    zstack_job = zstack.ZStackJob(
+        stage,
+        axis,
+        controller_handle,
+        float(start),
+        float(stop),
+        float(step),
+        frames=int(frames),
+        channel=channel,
+    )
+    zstack_job.start()
+    return zstack_job.report()
+
+
+@flask_app.route("/zstack/status")
+def zstack_status():
+    if zstack_job is None:
+        return {"state": "idle"}
+    return zstack_job.report()
+
+
+@flask_app.route("/zstack/cancel")
+def zstack_cancel():
+    if zstack_job is not None:
+        zstack_job.cancel()
+    return "Done."
+
+
+flyscan_job = None
+
+
+@flask_app.route(
+    "/flyscan/start/<ax>/<start>/<stop>/<speed>/<spacing>/<frames>/<channel>"
+)
+def flyscan_start(ax, start, stop, speed, spacing, frames, channel):
+    global flyscan_job
+    if flyscan_job is not None and flyscan_job.is_alive():
+        return {"error": "A fly scan is already running"}, 409
+
+    stage, axis = channel_map[int(ax)]
+    flyscan_job = fly_scan.FlyScanJob(
+        stage,
+        axis,
+        controller_handle,
+        float(start),
+        float(stop),
+        float(speed),
+        float(spacing),
+        frames=int(frames),
+        channel=None if channel.startswith("A") else int(channel),
+        by_position=flask.request.args.get("by_position", "0") == "1",
+    )
+    flyscan_job.start()
+    return flyscan_job.report()
+
+
+@flask_app.route("/flyscan/status")
+def flyscan_status():
+    if flyscan_job is None:
+        return {"state": "idle"}
+    return flyscan_job.report()
+
+
+@flask_app.route("/flyscan/cancel")
+def flyscan_cancel():
+    if flyscan_job is not None:
+        flyscan_job.cancel()
+    return "Done."
+
+
+tilescan_job = None
+
+
+def tiles_from_request(body):
+    # {"tiles": [[x, y], ...]}, or a grid / ROI mask with "origin" and "spacing"
+    if "tiles" in body:
+        return [tuple(t) for t in body["tiles"]]
+    x0, y0 = body["origin"]
+    dx, dy = body["spacing"]
+    if "mask" in body:
+        return tile_scan.mask_tiles(body["mask"], x0, y0, dx, dy)
+    nx, ny = body["count"]
+    return tile_scan.grid_tiles(x0, y0, nx, ny, dx, dy)
+
+
+@flask_app.route("/tilescan/plan", methods=["POST"])
+def tilescan_plan():
+    tiles = tiles_from_request(flask.request.get_json())
+    cost = tile_scan.TravelModel.for_channels(channel_map, axis_map["x"], axis_map["y"])
+    # Planned inside the request, so give 2-opt a short budget
+    order = tile_scan.plan_tiles(tiles, cost, time_limit=0.5)
+    return {"order": order, "estimated_time": tile_scan.estimate_scan_time(order, cost)}
+
+
+@flask_app.route("/tilescan/start", methods=["POST"])
+def tilescan_start():
+    global tilescan_job
+    if tilescan_job is not None and tilescan_job.is_alive():
+        return {"error": "A tile scan is already running"}, 409
+
+    body = flask.request.get_json()
+    tilescan_job = tile_scan.TileScanJob(
+        channel_map,
+        axis_map["x"],
+        axis_map["y"],
+        controller_handle,
+        tiles_from_request(body),
+        frames=int(body.get("frames", 1)),
+        channel=body.get("channel"),
+        tolerance=float(body.get("tolerance", 1e-3)),
+    )
+    tilescan_job.start()
+    return tilescan_job.report()
+
+
+@flask_app.route("/tilescan/status")
+def tilescan_status():
+    if tilescan_job is None:
+        return {"state": "idle"}
+    return tilescan_job.report()
+
+
+@flask_app.route("/tilescan/cancel")
+def tilescan_cancel():
+    if tilescan_job is not None:
+        tilescan_job.cancel()
+    return "Done."
+
+
 @flask_app.route("/move/<ax>/<loc>")
 def move(ax, loc):
     ax, loc = int(ax), float(loc)
@@ -129,6 +343,37 @@ def move(ax, loc):
     return "Done."
 
 
+@flask_app.route("/move_channels")
+def move_channels():
+    # EX: /move_channels?1=10.5&3=2.0&timeout=30&tolerance=0.001
+    args = flask.request.args.to_dict()
+    try:
+        timeout = float(args.pop("timeout")) if "timeout" in args else None
+        tolerance = float(args.pop("tolerance", 1e-3))
+        targets = {(int(k) if k.isdigit() else k): float(v) for k, v in args.items()}
+        return stage_control.coordinated_move(
+            channel_map, targets, timeout=timeout, tolerance=tolerance
+        )
+    except TimeoutError as e:
+        return {"error": str(e)}, 504
+    except KeyError as e:
+        return {"error": f"Unknown channel {e}"}, 400
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except RuntimeError as e:
+        # A channel stopped short of its target, e.g. on a limit or an abort
+        return {"error": str(e)}, 500
+
+
+@flask_app.route("/calibrate/<ax>")
+def calibrate(ax):
+    # Makes several out-and-back moves on the axis; it ends where it started
+    stage, i = channel_map[int(ax)]
+    model = motion_model.calibrate(stage, i)
+    stage.set_motion_model(i, model)
+    return model.to_dict()
+
+
 @flask_app.route("/velocity/<ax>/<speed>")
 def velocity(ax, speed):
     ax, speed = int(ax), float(speed)
@@ -136,25 +381,76 @@ def velocity(ax, speed):
     return "Done."
 
 
+def get_snapshots():
+    # ?fresh=1 forces a synchronous query instead of the cached poller state
+    fresh = flask.request.args.get("fresh", "0") == "1"
+    snapshots = {}
+    for s, c in channel_map.values():
+        if id(s) not in snapshots:
+            snapshots[id(s)] = s.get_snapshot(fresh=fresh)
+    return snapshots
+
+
 @flask_app.route("/is_moving")
 def is_moving():
-    return {"is_moving": any(s.get_is_moving()[c] for s, c in channel_map.values())}
+    snapshots = get_snapshots()
+    return {
+        "is_moving": any(
+            snapshots[id(s)].axes_moving[c] for s, c in channel_map.values()
+        )
+    }
 
 
 @flask_app.route("/get_is_moving")
 def get_moving():
-    return {cid: s.get_is_moving()[c] for cid, (s, c) in channel_map.items()}
+    snapshots = get_snapshots()
+    return {cid: snapshots[id(s)].axes_moving[c] for cid, (s, c) in channel_map.items()}
 
 
 @flask_app.route("/get_positions")
 def get_positions():
-    return {cid: s.get_current_position()[c] for cid, (s, c) in channel_map.items()}
+    snapshots = get_snapshots()
+    return {cid: snapshots[id(s)].position[c] for cid, (s, c) in channel_map.items()}
+
+
+@flask_app.route("/get_status")
+def get_status():
+    snapshots = get_snapshots()
+    return {
+        cid: {
+            "position": snapshots[id(s)].position[c],
+            "is_moving": snapshots[id(s)].axes_moving[c],
+            "timestamp": snapshots[id(s)].timestamp,
+        }
+        for cid, (s, c) in channel_map.items()
+    }
+
+
+@flask_app.route("/wait_for_move")
+def wait_for_move():
+    timeout = flask.request.args.get("timeout", type=float)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        for stage in stages:
+            stage.wait_for_move(deadline=deadline)
+    except TimeoutError:
+        return {"is_moving": True}
+    return {"is_moving": False}
+
+
+@flask_app.route("/io_stats")
+def io_stats():
+    return {
+        "stages": {i: s.io_stats() for i, s in enumerate(stages)},
+        "stop_latency": {i: s.stop_stats() for i, s in enumerate(stages)},
+        "trigger": controller_handle.io_stats(),
+        "dac": {k: v.io_stats() for k, v in list(DAC_handles.items())},
+    }
 
 
 @flask_app.route("/emergency_stop")
 def emergency_stop():
-    for stage in stages:
-        stage.emergency_stop()
+    stage_control.emergency_stop_all(stages)
     return "Done."
 
 
@@ -162,7 +458,7 @@ def emergency_stop():
 def reset_galvo(id):
     id = int(id)
     channel_map = {0: 488, 1: 560, 2: 642}
-    DAC_handles[channel_map[id]].reset()
+    get_dac(channel_map[id]).reset()
     return "Done."
 
 
@@ -170,16 +466,104 @@ def reset_galvo(id):
 def upload_wavetable(id):
     file = flask.request.files["file"]  # Access the uploaded file
     file = file.read()
-    file = file.strip().split(b",")
-    profile = [int(x, 16) for x in file]
+    try:
+        profile = stage_control.DACControl.load_table(file)
+        chunk = int(flask.request.args.get("chunk", stage_control.DEFAULT_CHUNK_SIZE))
+        if chunk <= 0:
+            raise ValueError(f"chunk must be positive, got {chunk}")
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    id = int(id)
+
+    channel_map = {0: 488, 1: 560, 2: 642}
+
+    get_dac(channel_map[id]).DAC_table = profile
+    force = flask.request.args.get("force", "0") == "1"
+    if flask.request.args.get("stream", "0") == "1":
+        # Return straight away; poll /upload_status/<id> for progress
+        dac_uploads[id] = get_dac(channel_map[id]).stream_table(
+            profile, chunk_size=chunk, force=force
+        )
+        return dac_uploads[id].report()
+    get_dac(channel_map[id]).send_wavetable(force=force)
+
+    return "Done."
+
+
+@flask_app.route("/generate_wavetable/<id>/<shape>")
+def generate_wavetable(id, shape):
+    # EX: /generate_wavetable/0/line_scan?amplitude=35000&offset=28000&flyback=0.04
+    args = flask.request.args
+    kw = {} if "flyback" not in args else {"flyback": float(args["flyback"])}
+    try:
+        profile = wavetable_gen.generate(
+            shape,
+            float(args["amplitude"]),
+            float(args["offset"]),
+            int(args.get("samples", 2554)),
+            **kw,
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": f"Bad waveform parameters: {e}"}, 400
 
     id = int(id)
+    channel_map = {0: 488, 1: 560, 2: 642}
+
+    dac = get_dac(channel_map[id])
+    dac.DAC_table = profile
+    force = args.get("force", "0") == "1"
+    done = dac.send_wavetable(force=force)
+
+    return {"samples": len(profile), "done": done}
 
+
+resample_sources = {}  # id -> (table the resampling started from, last result)
+
+
+@flask_app.route("/resample_wavetable/<id>/<length>")
+def resample_wavetable(id, length):
+    id = int(id)
     channel_map = {0: 488, 1: 560, 2: 642}
+    dac = get_dac(channel_map[id])
+
+    # Always resample the table we started from, so repeated speed changes
+    # don't compound interpolation error
+    source, last = resample_sources.get(id, (None, None))
+    if dac.DAC_table is not last:
+        source = dac.DAC_table
 
-    DAC_handles[channel_map[id]].DAC_table = profile
-    DAC_handles[channel_map[id]].send_wavetable()
+    method = flask.request.args.get("method", "cubic")
+    try:
+        length = int(length)
+        profile = wavetables.resample(source, length, method)
+    except ValueError as e:  # bad length or method, or over MAX_TABLE_SAMPLES
+        return {"error": str(e)}, 400
+    resample_sources[id] = (source, profile)
 
+    dac.DAC_table = profile
+    force = flask.request.args.get("force", "0") == "1"
+    done = dac.send_wavetable(force=force)
+
+    return {"samples": len(profile), "source_samples": len(source), "done": done}
+
+
+dac_uploads = {}
+
+
+@flask_app.route("/upload_status/<id>")
+def upload_status(id):
+    upload = dac_uploads.get(int(id))
+    if upload is None:
+        return {"state": "idle"}
+    return upload.report()
+
+
+@flask_app.route("/upload_cancel/<id>")
+def upload_cancel(id):
+    upload = dac_uploads.get(int(id))
+    if upload is not None:
+        upload.cancel()
     return "Done."
 
 
@@ -187,15 +571,22 @@ def upload_wavetable(id):
 def upload_aotf(id):
     file = flask.request.files["file"]  # Access the uploaded file
     file = file.read()
-    file = file.strip()  # EX: b'YYYYNNNNYYYYY'
+    file = file.strip()  # EX: b'YYYYNNNNYYYYY' or b'off:150,on:2304,off:100'
 
-    profile = [(1 if (x == ord(b"Y")) else 0) for x in file]
+    try:
+        if b":" in file:
+            profile = wavetables.GatingTable.from_spec(file.decode())
+        else:
+            profile = wavetables.GatingTable.from_flags(file, on=b"Y")
+    except (UnicodeDecodeError, ValueError) as e:
+        return {"error": str(e)}, 400
 
     id = int(id)
     channel_map = {0: 488, 1: 560, 2: 642}
 
-    DAC_handles[channel_map[id]].AOTF_table = profile
-    DAC_handles[channel_map[id]].send_AOTF_table()
+    get_dac(channel_map[id]).AOTF_table = profile
+    force = flask.request.args.get("force", "0") == "1"
+    get_dac(channel_map[id]).send_AOTF_table(force=force)
 
     return "Done."
 
@@ -230,16 +621,15 @@ while True:
                 if control == 7:
                     value *= -1
                 if abs(value) < 0.01:  # eps
-                    stages[1].stop(1)
+                    jog.stop(stages[1], 1)
                 else:
-                    direction = "+" if value > 0 else "-"
                     velocity = 0
                     if control == 7:
                         velocity = z_velocity_max
                     elif control == 6:
                         velocity = z_velocity_max / 10
-                    stages[1].send_velocity(1, velocity)
-                    stages[1].send_move_indefinite(1, direction)
+                    velocity *= 1 if value > 0 else -1
+                    jog.set_velocity(stages[1], 1, velocity)
                 # 6 == dpad horizontal; 7 == dpad vertical
             elif control == "LT":
                 pass
@@ -252,16 +642,13 @@ while True:
                 ax = right_channel_map[ax]
 
                 if abs(value) < deadzone:
-                    stages[0].stop(ax)
+                    jog.stop(stages[0], ax)
                     # print("Stopping Axis")
                 else:
                     velocity = right_velocity_scale * right_velocity_max * value / 100
                     velocity *= 0.04 if left else 1.0
-                    direction = "+" if (velocity > 0) else "-"
-                    velocity = abs(velocity)
 
-                    stages[0].send_velocity(ax, velocity)
-                    stages[0].send_move_indefinite(ax, direction)
+                    jog.set_velocity(stages[0], ax, velocity)
                     # print("New Velocity:", velocity)
             else:
                 print(eventType, control, value)
@@ -271,8 +658,9 @@ while True:
                     for ax in right_channel_map.values():
                         stages[0].send_enable_axis(0)
                 elif control == "X":
-                    stages[0].stop(1)
-                    stages[0].stop(2)
+                    jog.cancel()
+                    with stages[0].frame() as f:
+                        f.stop(1).stop(2)
                     stages[1].stop(1)
                 elif control == "B":
                     right_velocity_scale -= 20
@@ -282,14 +670,14 @@ while True:
                 elif control == "A":
                     controller_handle.send_trigger(channel=None, frames=1, stage=False)
                 elif control == "RB":
-                    for ax in right_channel_map.values():
-                        stages[0].stop(ax)
-                        stages[0].send_velocity(ax, right_velocity_max)
-                        stages[0].home(ax)
+                    jog.cancel()
+                    with stages[0].frame() as f:
+                        for ax in right_channel_map.values():
+                            f.stop(ax).velocity(ax, right_velocity_max).home(ax)
                 elif control == "LB":
-                    stages[1].stop(1)
-                    stages[1].send_velocity(1, z_velocity_max)
-                    stages[1].home(1)
+                    jog.cancel()
+                    with stages[1].frame() as f:
+                        f.stop(1).velocity(1, z_velocity_max).home(1)
                 elif control == "START":
                     trigger_frame(cmd="S")
                 else:
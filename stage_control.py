@@ -1,12 +1,602 @@
+import collections
+import hashlib
+import inspect
+import json
+import os
+import queue
+import select
 import serial
 import threading
 import time
+from concurrent.futures import Future
+from dataclasses import dataclass
 
+import wavetables
+from wavetables import GatingTable, Wavetable
 
-class ESP302StageControl:
-    def __init__(self, serial_name: str, serial_baud: int, timeout: int):
+
+def parse_moving(rv: bytes) -> dict:
+    rv = bin(rv[0])[2:][::-1][:3]
+    return {i + 1: (v == "1") for i, v in enumerate(rv)}  # check order
+
+
+def _report_failure(future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Serial command failed: {future.exception()}")
+
+
+class SerialWorker(threading.Thread):
+    """I/O thread which owns a serial port for a SerialDevice in threaded mode.
+
+    Jobs run one at a time in submission order. Each submit returns a
+    concurrent.futures.Future for the job's result.
+    """
+
+    def __init__(self, name: str):
+        threading.Thread.__init__(self, name=f"serial-io {name}", daemon=True)
+        self._queue = queue.Queue()
+        self.jobs_done = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, fn, *args) -> Future:
+        future = Future()
+        self._queue.put((time.monotonic(), future, fn, args))
+        return future
+
+    def close(self) -> None:
+        self._queue.put(None)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "jobs_done": self.jobs_done,
+            "mean_wait": self.total_wait / max(self.jobs_done, 1),
+            "max_wait": self.max_wait,
+        }
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            queued, future, fn, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            wait = time.monotonic() - queued
+            self.jobs_done += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class LineReader:
+    """Buffered line framing on top of a serial port.
+
+    pyserial's readline reads one byte per call. This reads everything the
+    port has waiting in one go, splits on the terminator and keeps any bytes
+    after it for the next reply.
+    """
+
+    def __init__(self, port, terminator: bytes = b"\n"):
+        self._port = port
+        self.terminator = terminator
+        self._buffer = bytearray()
+
+    def _pop_line(self, terminator: bytes):
+        i = self._buffer.find(terminator)
+        if i < 0:
+            return None
+        end = i + len(terminator)
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return line
+
+    def _wait_readable(self, timeout: float) -> bool:
+        if self._port.in_waiting > 0:
+            return True
+        readable, _, _ = select.select([self._port.fileno()], [], [], timeout)
+        return len(readable) > 0
+
+    def readline(self, timeout: float = None, terminator: bytes = None) -> bytes:
+        """Return the next line including its terminator, or b"" on timeout.
+
+        A partial line is kept in the buffer on timeout. timeout defaults to
+        the port's own timeout. The port's timeout is never changed: on
+        ports with a fileno() the wait is done with select, so any deadline
+        is kept. Elsewhere each read may block for up to the port timeout.
+        """
+        terminator = self.terminator if terminator is None else terminator
+        line = self._pop_line(terminator)
+        if line is not None:
+            return line
+
+        if timeout is None:
+            timeout = self._port.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        use_select = deadline is not None and hasattr(self._port, "fileno")
+        while True:
+            if use_select:
+                left = deadline - time.monotonic()
+                if left <= 0 or not self._wait_readable(left):
+                    return b""
+            # Blocks until at least one byte arrives, then takes the rest in bulk
+            chunk = self._port.read(max(1, self._port.in_waiting))
+            self._buffer += chunk
+            line = self._pop_line(terminator)
+            if line is not None:
+                return line
+            if deadline is not None and time.monotonic() >= deadline:
+                return b""
+
+    def reset(self) -> None:
+        self._buffer.clear()
+        self._port.reset_input_buffer()
+
+
+class SerialDevice:
+    """A serial port shared between threads, with buffered reads (LineReader).
+
+    By default every transaction takes a lock. With threaded=True the port is
+    owned by a SerialWorker instead and callers queue jobs on it, so
+    fire-and-forget writes return without waiting for the port.
+
+    Every write also takes _write_mutex, which is only held for the write
+    itself. Priority writes (stops) take just that lock, so they never wait
+    behind a pending reply.
+    """
+
+    _TERMINATOR = b"\n"
+
+    def __init__(
+        self, serial_name: str, serial_baud: int, timeout: int, threaded=False
+    ):
         self._serial = serial.Serial(serial_name, serial_baud, timeout=timeout)
+        self._reader = LineReader(self._serial, self._TERMINATOR)
         self._serial_mutex = threading.Lock()
+        self._write_mutex = threading.Lock()
+        self._worker = None
+        if threaded:
+            self._worker = SerialWorker(serial_name)
+            self._worker.start()
+
+    def close(self) -> None:
+        self._run(self._serial.close)
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            worker.close()
+
+    def submit(self, fn, *args) -> Future:
+        """Run fn(*args) with exclusive use of the port and return a Future."""
+        if self._worker is not None:
+            return self._worker.submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(self._run(fn, *args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _run(self, fn, *args):
+        if self._worker is None:
+            with self._serial_mutex:
+                return fn(*args)
+        return self._worker.submit(fn, *args).result()
+
+    def _post(self, fn, *args) -> None:
+        if self._worker is None:
+            self._run(fn, *args)
+        else:
+            self._worker.submit(fn, *args).add_done_callback(_report_failure)
+
+    def _write(self, payload: bytes) -> int:
+        with self._write_mutex:
+            return self._serial.write(payload)
+
+    def _write_buffer(self, payload) -> int:
+        """Write any buffer to the port without pyserial copying it to bytes."""
+        if isinstance(payload, bytes) or not hasattr(self._serial, "fileno"):
+            return self._write(payload)
+        fd = self._serial.fileno()
+        view = memoryview(payload)
+        with self._write_mutex:
+            while len(view) > 0:
+                try:
+                    view = view[os.write(fd, view) :]
+                except BlockingIOError:
+                    # pyserial opens POSIX ports non-blocking
+                    select.select([], [fd], [])
+        return len(payload)
+
+    def _readline(self, timeout: float = None) -> bytes:
+        return self._reader.readline(timeout).strip()
+
+    def _query_line(self, payload: bytes, timeout: float = None) -> bytes:
+        self._write(payload)
+        return self._readline(timeout)
+
+    def io_stats(self) -> dict:
+        if self._worker is None:
+            return {}
+        return self._worker.stats()
+
+
+PRIORITY_COMMANDS = ("ST", "AB")
+
+
+def encode_command(axis, mnemonic: str, value=None) -> bytes:
+    prefix = "" if axis is None else str(axis)
+    suffix = "" if value is None else str(value)
+    return bytes(f"{prefix}{mnemonic}{suffix}\n", "utf-8")
+
+
+class CommandFrame:
+    """A batch of ESP commands which goes out to the controller in one write.
+
+    Build it up with the command helpers and send it with send(), or use it as
+    a context manager, in which case it is sent on exit:
+
+        with stage.frame() as f:
+            f.velocity(1, 2.0).move_indefinite(1, "+")
+
+    Frames for the asyncio stages must use "async with" instead.
+
+    stops is the stage's stop/abort state when the frame was started. The
+    frame's commands are dropped on any axis stopped since then, even if
+    the frame is sent afterwards.
+    """
+
+    def __init__(self, stage=None, stops: tuple = None):
+        self._stage = stage
+        self.stops = stops
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            rv = self.send()
+            if inspect.iscoroutine(rv):
+                rv.close()
+                raise TypeError("Frames for async stages need 'async with'")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.send()
+
+    def add(self, mnemonic: str, axis: int = None, value=None) -> "CommandFrame":
+        self.commands.append((axis, mnemonic, value))
+        return self
+
+    def home(self, axis: int = None) -> "CommandFrame":
+        return self.add("OR", axis)
+
+    def stop(self, axis: int) -> "CommandFrame":
+        return self.add("ST", axis)
+
+    def abort(self) -> "CommandFrame":
+        return self.add("AB")
+
+    def wait(self, ms: int) -> "CommandFrame":
+        return self.add("WT", None, ms)
+
+    def move(self, axis: int, position: float) -> "CommandFrame":
+        return self.add("PA", axis, position)
+
+    def velocity(self, axis: int, velocity: float) -> "CommandFrame":
+        return self.add("VA", axis, velocity)
+
+    def move_indefinite(self, axis: int, dir: str) -> "CommandFrame":
+        if not ((dir == "+") or (dir == "-")):
+            return self
+        return self.add("MV", axis, dir)
+
+    def enable_axis(self, axis: int) -> "CommandFrame":
+        return self.add("MO", axis)
+
+    def encode(self) -> bytes:
+        return b"".join(encode_command(*c) for c in self.commands)
+
+    def send(self):
+        return self._stage.send_frame(self)
+
+
+@dataclass(frozen=True)
+class StageSnapshot:
+    position: dict
+    axes_moving: dict
+    timestamp: float
+    error_code: int = None
+    error_message: str = None
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.timestamp
+
+
+def split_reply(rv: bytes) -> list:
+    return [x.strip() for x in rv.split(b",")]
+
+
+def reply_matches(line: bytes, payload: bytes, axes: int) -> bool:
+    """Whether line has the shape of the reply to payload (;-joined queries).
+
+    TP gives one number per axis (one for nTP), TS a single status byte and
+    TB three or more fields, since its message may contain commas. Anything
+    else is expected to give one field.
+    """
+    rv = split_reply(line)
+    i = 0
+    for query in payload.strip().split(b";"):
+        mnemonic = query.lstrip(b"0123456789")
+        if mnemonic.startswith(b"TB"):
+            return i + 3 <= len(rv)
+        n = axes if query == b"TP" else 1
+        fields, i = rv[i : i + n], i + n
+        if len(fields) < n:
+            return False
+        for field in fields:
+            if mnemonic.startswith(b"TS") and len(field) != 1:
+                return False
+            if mnemonic.startswith(b"TP"):
+                try:
+                    float(field)
+                except ValueError:
+                    return False
+    return i == len(rv)
+
+
+def status_queries(axes: tuple, errors: bool = False) -> list:
+    queries = [f"{axis}TP" for axis in axes] + ["TS"]
+    if errors:
+        queries.append("TB")
+    return queries
+
+
+def parse_status(axes: tuple, rv: list, errors: bool = False) -> StageSnapshot:
+    """Parse the split reply to status_queries(axes, errors)."""
+    timestamp = time.time()
+    if len(rv) < len(axes) + 1:
+        raise ValueError(f"Short status reply from controller: {rv}")
+
+    error_code, error_message = None, None
+    if errors:
+        # TB replies "code, timestamp, message", which is split on the commas too
+        error_code = int(rv[len(axes) + 1])
+        error_message = b", ".join(rv[len(axes) + 3 :]).decode("utf-8")
+
+    moving = parse_moving(rv[len(axes)])
+    return StageSnapshot(
+        position={axis: float(x) for axis, x in zip(axes, rv)},
+        axes_moving={axis: moving.get(axis, False) for axis in axes},
+        timestamp=timestamp,
+        error_code=error_code,
+        error_message=error_message,
+    )
+
+
+def track_commands(commands: list, targets: dict, velocities: dict) -> None:
+    # Remember PA targets and VA velocities for move time estimates
+    for axis, mnemonic, value in commands:
+        if mnemonic == "PA":
+            targets[axis] = float(value)
+        elif mnemonic == "VA":
+            velocities[axis] = float(value)
+        elif mnemonic in ("ST", "MV", "OR"):
+            targets.pop(axis, None)
+        elif mnemonic == "AB":
+            targets.clear()
+
+
+def estimate_remaining(axes: list, position: dict, targets: dict, velocities: dict):
+    # Rough time left on the tracked PA moves, None when it cannot be estimated
+    remaining = 0.0
+    for axis in axes:
+        if axis not in targets:
+            return None
+        velocity = velocities.get(axis)
+        if not velocity:
+            return None
+        distance = abs(targets[axis] - position[axis])
+        remaining = max(remaining, distance / velocity)
+    return remaining
+
+
+def poll_interval(previous: float, remaining, min_interval, max_interval) -> float:
+    # Half the remaining time when known, otherwise back off geometrically
+    if remaining is None:
+        return min(previous * 2, max_interval)
+    return min(max(remaining / 2, min_interval), max_interval)
+
+
+class StatusPoller(threading.Thread):
+    """Thread which keeps the cached StageSnapshot of a stage up to date.
+
+    One of these is created by ESPStageControl.start_poller and closed by stop_poller
+    """
+
+    def __init__(self, stage, rate: float):
+        threading.Thread.__init__(self, daemon=True)
+        self.stage = stage
+        self.interval = 1.0 / rate
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self):
+        next_poll = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                self.stage._read_snapshot()
+            except Exception as e:
+                print(f"Status poll failed on {self.stage._serial.name}: {e}")
+            next_poll = max(next_poll + self.interval, time.monotonic())
+            self._stop_event.wait(next_poll - time.monotonic())
+
+
+class QueryPipeline(threading.Thread):
+    """Keeps several queries in flight on one device and matches replies FIFO.
+
+    Queries are written back to back as they are submitted and this thread
+    hands each reply line to the oldest waiting Future. At most depth
+    queries are outstanding. In threaded mode the write is queued on the
+    device's I/O thread, so a query never overtakes a command sent before
+    it.
+
+    A reply is only handed over if it passes the query's check (e.g. field
+    count). If it fails, or the oldest query gets no reply within
+    reply_timeout, every in-flight query fails with TimeoutError and the
+    input is drained. The check only catches a lost reply when the next
+    query's reply has a different shape. Two queries with the same shape
+    (or no check) can still swap replies, and that is only noticed when
+    the last query times out.
+
+    Once stopped, queries still in flight and any submitted afterwards fail
+    with RuntimeError.
+    """
+
+    def __init__(self, device: SerialDevice, depth: int = 4, reply_timeout=1.0):
+        threading.Thread.__init__(self, daemon=True)
+        self._device = device
+        self._slots = threading.Semaphore(depth)
+        self._in_flight = collections.deque()
+        self.reply_timeout = reply_timeout
+        self.running = True
+        self.resync_count = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def _send(self, payload: bytes, future: Future, check) -> None:
+        # Writes and queue order must agree, so both happen under the write lock
+        with self._device._write_mutex:
+            if not self.running:
+                # Stopped while this write was queued; nothing would read the reply
+                self._slots.release()
+                future.set_exception(RuntimeError("Query pipeline is stopped"))
+                return
+            self._in_flight.append((time.monotonic(), future, check))
+            try:
+                self._device._serial.write(payload)
+            except Exception as e:
+                self._in_flight.pop()
+                self._slots.release()
+                future.set_exception(e)
+
+    def submit(self, payload: bytes, check=None) -> Future:
+        """Send a query; check(line) -> bool validates the reply if given."""
+        self._slots.acquire()
+        future = Future()
+        if not self.running:
+            # Pass the wake-up from stop() on to the next blocked caller
+            self._slots.release()
+            future.set_exception(RuntimeError("Query pipeline is stopped"))
+            return future
+        if self._device._worker is None:
+            self._send(payload, future, check)
+        else:
+            self._device._worker.submit(self._send, payload, future, check)
+        return future
+
+    def query(self, payload: bytes) -> bytes:
+        return self.submit(payload).result()
+
+    def _resolve(self, line: bytes) -> None:
+        if not self._in_flight:
+            print(f"Discarding unexpected reply {line!r}")
+            return
+        _, _, check = self._in_flight[0]
+        line = line.strip()
+        if check is not None and not check(line):
+            print(f"Reply {line!r} does not match its query, resynchronising")
+            self._resync("Reply lost or out of order")
+            return
+        _, future, _ = self._in_flight.popleft()
+        self._slots.release()
+        future.set_result(line)
+
+    def _resync(self, reason: str = "No reply from controller") -> None:
+        with self._device._write_mutex:
+            self.resync_count += 1
+            while self._in_flight:
+                _, future, _ = self._in_flight.popleft()
+                self._slots.release()
+                future.set_exception(TimeoutError(reason))
+            while len(self._device._reader.readline(timeout=0.05)) > 0:
+                pass  # let late replies arrive and throw them away
+            self._device._reader.reset()
+
+    def stop(self) -> None:
+        self.running = False
+        self._slots.release()  # wake a caller blocked waiting for a slot
+
+    def _fail_in_flight(self) -> None:
+        with self._device._write_mutex:
+            while self._in_flight:
+                _, future, _ = self._in_flight.popleft()
+                self._slots.release()
+                future.set_exception(RuntimeError("Query pipeline is stopped"))
+
+    def run(self):
+        # Short reads, so stop() is noticed without waiting out reply_timeout
+        poll = min(self.reply_timeout, 0.1)
+        try:
+            while self.running:
+                line = self._device._reader.readline(timeout=poll)
+                if len(line) > 0:
+                    self._resolve(line)
+                elif self._in_flight:
+                    sent, _, _ = self._in_flight[0]
+                    if time.monotonic() - sent >= self.reply_timeout:
+                        self._resync()
+        finally:
+            self._fail_in_flight()
+
+
+class ESPStageControl(SerialDevice):
+    _HOME_ALL_AXIS = None
+    _AXES = (1, 2, 3)
+    _PROGRAM_SLOTS = range(50, 100)  # leave the low numbers for hand-written programs
+    _PREDICT_MAX_AGE = 0.5  # s; older snapshots aren't used to predict moves
+
+    def __init__(
+        self, serial_name: str, serial_baud: int, timeout: int, threaded=False
+    ):
+        SerialDevice.__init__(self, serial_name, serial_baud, timeout, threaded)
+        self._snapshot = None
+        self._poller = None
+        self._pipeline = None
+        self._programs = collections.OrderedDict()  # content hash -> program number
+        self._targets = {}
+        self._velocities = {}
+        self._predicted_end = {}
+        self._motion_sent = {}  # axis (None for all) -> time.time() of last motion
+        self.motion_models = {}
+        self._sent_velocity = {}
+        self._sent_direction = {}
+        self.suppressed_commands = 0
+        self.bytes_saved = 0
+        self._stop_counts = {}
+        self._abort_count = 0
+        self.stop_latencies = collections.deque(maxlen=100)
 
     def __del__(self):
         self.close()
@@ -20,190 +610,581 @@ class ESP302StageControl:
         )
 
     def close(self) -> None:
-        with self._serial_mutex:
-            self._serial.close()
+        self.stop_poller()
+        self.stop_pipeline()
+        SerialDevice.close(self)
 
-    def home(self, axis: int) -> None:
-        cmd = f"{axis}OR\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+    def start_pipeline(self, depth: int = 4, reply_timeout: float = 1.0) -> None:
+        """Let queries from different threads be in flight at the same time."""
+        if self._pipeline is not None:
+            raise RuntimeError("Query pipeline is already running")
+        self._pipeline = QueryPipeline(self, depth, reply_timeout)
+        self._pipeline.start()
 
-    def home_all(self) -> None:
-        with self._serial_mutex:
-            self._serial.write(b"OR\n")
+    def stop_pipeline(self) -> None:
+        pipeline, self._pipeline = getattr(self, "_pipeline", None), None
+        if pipeline is not None:
+            pipeline.stop()
+            pipeline.join()
 
-    def get_current_position(self) -> dict:
-        with self._serial_mutex:
-            self._serial.write(b"TP\n")
-            rv = self._serial.readline().strip().split(b",")
-            return {i + 1: float(x) for i, x in enumerate(rv)}
+    def submit_query(self, queries: list) -> Future:
+        payload = bytes(";".join(queries) + "\n", "utf-8")
+        if self._pipeline is not None:
+            return self._pipeline.submit(payload, self._reply_check(payload))
+        return self.submit(self._query_line, payload)
 
-    def emergency_stop(self, axis: int) -> None:
-        with self._serial_mutex:
-            self._serial.write(b"AB\n")
+    def _reply_check(self, payload: bytes):
+        return lambda line: reply_matches(line, payload, len(self._AXES))
 
-    def stop(self, axis: int) -> None:
-        cmd = f"{axis}ST\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+    def _query_reply(self, payload: bytes) -> bytes:
+        if self._pipeline is not None:
+            return self._pipeline.submit(payload, self._reply_check(payload)).result()
+        return self._run(self._query_line, payload)
 
-    def get_is_moving(self) -> dict:
-        with self._serial_mutex:
-            self._serial.write(b"TS\n")
-            rv = self._serial.readline().strip()  # get result from stage
-            rv = bin(rv[0])[2:][::-1][:3]
-            return {i + 1: (v == "1") for i, v in enumerate(rv)}  # check order
+    def start_poller(self, rate: float = 10.0) -> None:
+        if self._poller is not None:
+            raise RuntimeError("Status poller is already running")
+        self._poller = StatusPoller(self, rate)
+        self._poller.start()
 
-    def is_moving(self) -> bool:
-        return any(self.get_is_moving().values())
+    def stop_poller(self) -> None:
+        poller, self._poller = getattr(self, "_poller", None), None
+        if poller is not None:
+            poller.stop()
+            if poller is not threading.current_thread():
+                poller.join()
 
-    def wait_for_move(self) -> None:
-        while self.is_moving():
-            pass  # maybe replace with less busy wait
+    def _read_snapshot(self) -> StageSnapshot:
+        self._snapshot = self.query_status()
+        return self._snapshot
 
-    def send_move(self, axis: int, position: float) -> None:
-        cmd = f"WT50\n{axis}PA{position}\n"
-        self.stop(axis)
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+    def get_snapshot(self, fresh: bool = False) -> StageSnapshot:
+        snapshot = self._snapshot
+        if fresh or snapshot is None or self._poller is None:
+            snapshot = self._read_snapshot()
+        return snapshot
 
-    def send_velocity(self, axis: int, velocity: float) -> None:
-        cmd = f"{axis}VA{velocity}\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+    def _stop_state(self) -> tuple:
+        return self._abort_count, dict(self._stop_counts)
 
-    def send_move_indefinite(self, axis: int, dir: str) -> None:
-        if not ((dir == "+") or (dir == "-")):
+    def frame(self) -> CommandFrame:
+        return CommandFrame(self, self._stop_state())
+
+    def send_frame(self, frame: CommandFrame) -> None:
+        if len(frame) == 0:
             return
-        cmd = f"{axis}MV{dir}\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+        commands = list(frame.commands)
+        if all(mnemonic in PRIORITY_COMMANDS for _, mnemonic, _ in commands):
+            self._send_priority(commands)
+        else:
+            stops = self._stop_state() if frame.stops is None else frame.stops
+            self._post(self._send_commands, commands, stops)
 
-    def send_move_wait(self, axis: int, position: float) -> None:
-        self.send_move(axis, position)
-        self.wait_for_move()
+    def _send_priority(self, commands: list) -> None:
+        # Stops skip the command queue and any pending reply; they only wait
+        # for a write already in progress.
+        start = time.monotonic()
+        with self._write_mutex:
+            for axis, mnemonic, _ in commands:
+                if mnemonic == "AB" or axis is None:
+                    self._abort_count += 1
+                else:
+                    self._stop_counts[axis] = self._stop_counts.get(axis, 0) + 1
+            try:
+                self._serial.write(b"".join(encode_command(*c) for c in commands))
+            finally:
+                self._invalidate_command_cache()
+                self._track_commands(commands)
+        self.stop_latencies.append(time.monotonic() - start)
 
-    def send_enable_axis(self, axis: int) -> None:
-        cmd = f"{axis}MO\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+    def _send_commands(self, commands: list, stops: tuple = None) -> None:
+        with self._write_mutex:
+            if stops is not None:
+                commands = self._drop_stopped(commands, *stops)
+            commands, velocity, direction = self._suppress_redundant(commands)
+            if len(commands) == 0:
+                return
+            try:
+                self._serial.write(b"".join(encode_command(*c) for c in commands))
+            except Exception:
+                self._invalidate_command_cache()
+                raise
+            self._sent_velocity, self._sent_direction = velocity, direction
+            self._track_commands(commands)
 
-    def status(self) -> dict:
+    def _drop_stopped(self, commands: list, abort_count: int, stop_counts: dict):
+        # Commands queued before a stop/abort on their axis must not restart it
+        if abort_count != self._abort_count:
+            return []
+        return [
+            (axis, mnemonic, value)
+            for axis, mnemonic, value in commands
+            if axis is None or stop_counts.get(axis) == self._stop_counts.get(axis)
+        ]
+
+    def io_stats(self) -> dict:
+        stats = SerialDevice.io_stats(self)
+        stats["suppressed_commands"] = self.suppressed_commands
+        stats["bytes_saved"] = self.bytes_saved
+        return stats
+
+    def stop_stats(self) -> dict:
+        latencies = list(self.stop_latencies)
         return {
-            "position": self.get_current_position(),
-            "axes_moving": self.get_is_moving(),
-            "stage_active_flag": self.is_moving(),
+            "count": len(latencies),
+            "mean": sum(latencies) / max(len(latencies), 1),
+            "max": max(latencies, default=0.0),
         }
 
+    def _suppress_redundant(self, commands: list) -> tuple:
+        # Drop VA/MV commands which would not change the controller's state.
+        # Returns the commands to send and the cache state after sending them.
+        velocity = dict(self._sent_velocity)
+        direction = dict(self._sent_direction)
+        kept = []
+        for axis, mnemonic, value in commands:
+            if mnemonic == "VA":
+                if velocity.get(axis) == float(value):
+                    self._count_suppressed(axis, mnemonic, value)
+                    continue
+                velocity[axis] = float(value)
+            elif mnemonic == "MV":
+                # A jog only carries on unchanged if VA hasn't changed since it began
+                if direction.get(axis) == (value, velocity.get(axis)):
+                    self._count_suppressed(axis, mnemonic, value)
+                    continue
+                direction[axis] = (value, velocity.get(axis))
+            elif mnemonic == "PA":
+                direction.pop(axis, None)
+            elif mnemonic != "WT":
+                if axis is None:
+                    velocity.clear()
+                    direction.clear()
+                else:
+                    velocity.pop(axis, None)
+                    direction.pop(axis, None)
+            kept.append((axis, mnemonic, value))
+        return kept, velocity, direction
 
-class ESP300StageControl:
-    def __init__(self, serial_name: str, serial_baud: int, timeout: int):
-        self._serial = serial.Serial(serial_name, serial_baud, timeout=timeout)
-        self._serial_mutex = threading.Lock()
+    def _count_suppressed(self, axis, mnemonic: str, value) -> None:
+        self.suppressed_commands += 1
+        self.bytes_saved += len(encode_command(axis, mnemonic, value))
 
-    def __del__(self):
-        self.close()
+    def _invalidate_command_cache(self) -> None:
+        self._sent_velocity = {}
+        self._sent_direction = {}
 
-    def __repr__(self):
-        return (
-            "ESPStageControl(connected on "
-            + repr(self._serial)
-            + ") -> "
-            + repr(self.status())
-        )
+    def _observe_moving(self, moving: dict, error_code: int = None) -> None:
+        self._post(self._forget_stopped_jogs, moving, error_code)
 
-    def close(self) -> None:
-        with self._serial_mutex:
-            self._serial.close()
+    def _forget_stopped_jogs(self, moving: dict, error_code: int = None) -> None:
+        # Jogs can end without us (limits, errors), so forget them once stopped
+        with self._write_mutex:
+            if error_code:
+                self._invalidate_command_cache()
+            for axis, is_moving in moving.items():
+                if not is_moving:
+                    self._sent_direction.pop(axis, None)
+
+    def _start_position(self, axis: int, now: float):
+        # Where a PA sent now starts from, or None if that isn't known:
+        # the target of the last PA once its predicted end has passed, or
+        # else a recent snapshot, taken after the last motion command, of
+        # the axis at rest
+        end = self._predicted_end.get(axis)
+        if end is not None:
+            return self._targets.get(axis) if end <= now else None
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.age > self._PREDICT_MAX_AGE:
+            return None
+        sent = max(self._motion_sent.get(axis, 0.0), self._motion_sent.get(None, 0.0))
+        if snapshot.timestamp < sent or snapshot.axes_moving.get(axis, True):
+            return None
+        return snapshot.position.get(axis)
+
+    def _track_commands(self, commands: list) -> None:
+        now = time.monotonic()
+        delay = 0.0
+        for axis, mnemonic, value in commands:
+            start = None
+            if mnemonic == "PA" and axis in self.motion_models:
+                start = self._start_position(axis, now)
+            # Apply each command as it comes, so a VA is in effect for the PA
+            # that follows it in the same frame
+            track_commands([(axis, mnemonic, value)], self._targets, self._velocities)
+            if mnemonic in ("PA", "MV", "ST", "OR", "AB"):
+                self._motion_sent[axis] = time.time()
+            if mnemonic == "WT":
+                delay += float(value) / 1000
+            elif mnemonic == "PA" and start is not None:
+                # The move begins after any WT before it in the frame
+                model = self.motion_models[axis]
+                distance = float(value) - start
+                predicted = model.move_time(distance, self._velocities.get(axis))
+                self._predicted_end[axis] = now + delay + predicted
+            elif mnemonic == "PA":
+                # No trustworthy start position; wait_for_move polls instead
+                self._predicted_end.pop(axis, None)
+            elif mnemonic == "AB" or (mnemonic == "OR" and axis is None):
+                self._predicted_end.clear()
+            elif mnemonic in ("ST", "MV", "OR"):
+                self._predicted_end.pop(axis, None)
+
+    def set_motion_model(self, axis: int, model) -> None:
+        """Use a motion_model.AxisMotionModel to predict moves on axis."""
+        self.motion_models[axis] = model
+
+    def predict_move_time(self, axis: int, position: float, snapshot=None) -> float:
+        """Predicted seconds for a PA move of axis to position, None without a model."""
+        model = self.motion_models.get(axis)
+        if model is None:
+            return None
+        snapshot = self.get_snapshot() if snapshot is None else snapshot
+        distance = position - snapshot.position[axis]
+        return model.move_time(distance, self._velocities.get(axis))
 
     def home(self, axis: int) -> None:
-        cmd = f"{axis}OR\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+        with self.frame() as f:
+            f.home(axis)
 
     def home_all(self) -> None:
-        with self._serial_mutex:
-            self._serial.write(b"0OR\n")
+        with self.frame() as f:
+            f.home(self._HOME_ALL_AXIS)
+
+    def query(self, queries: list) -> list:
+        cmd = ";".join(queries) + "\n"
+        return split_reply(self._query_reply(bytes(cmd, "utf-8")))
+
+    def query_status(self, axes: tuple = None, errors: bool = False) -> StageSnapshot:
+        """Read positions, motion state and (optionally) TB in one round trip.
+
+        TB pops the oldest error off the controller's error buffer, so it is
+        only included when errors=True.
+        """
+        axes = self._AXES if axes is None else tuple(axes)
+        rv = self.query(status_queries(axes, errors))
+        snapshot = parse_status(axes, rv, errors)
+        self._observe_moving(snapshot.axes_moving, snapshot.error_code)
+        return snapshot
 
     def get_current_position(self) -> dict:
-        with self._serial_mutex:
-            self._serial.write(b"TP\n")
-            rv = self._serial.readline().strip().split(b",")
-            return {i + 1: float(x) for i, x in enumerate(rv)}
+        rv = self._query_reply(b"TP\n").split(b",")
+        return {i + 1: float(x) for i, x in enumerate(rv)}
 
-    def emergency_stop(self, axis: int) -> None:
-        with self._serial_mutex:
-            self._serial.write(b"AB\n")
+    def emergency_stop(self, axis: int = None) -> None:
+        with self.frame() as f:
+            f.abort()
 
     def stop(self, axis: int) -> None:
-        cmd = f"{axis}ST\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+        with self.frame() as f:
+            f.stop(axis)
 
     def get_is_moving(self) -> dict:
-        with self._serial_mutex:
-            self._serial.write(b"TS\n")
-            rv = self._serial.readline().strip()  # get result from stage
-            rv = bin(rv[0])[2:][::-1][:3]
-            return {i + 1: (v == "1") for i, v in enumerate(rv)}  # check order
+        rv = self._query_reply(b"TS\n")  # get result from stage
+        moving = parse_moving(rv)
+        self._observe_moving(moving)
+        return moving
 
     def is_moving(self) -> bool:
         return any(self.get_is_moving().values())
 
-    def wait_for_move(self) -> None:
-        while self.is_moving():
-            pass  # maybe replace with less busy wait
+    def wait_for_move(
+        self,
+        axis: int = None,
+        timeout: float = None,
+        deadline: float = None,
+        min_interval: float = 0.005,
+        max_interval: float = 0.25,
+        predict: bool = True,
+    ) -> None:
+        """Block until the stage (or a single axis) has stopped moving.
+
+        With a motion model for the moving axes (and predict=True) this first
+        sleeps until shortly before the predicted end of the move. The poll
+        interval is then half the estimated remaining move time, clamped to
+        [min_interval, max_interval], so polling backs off on long moves and
+        tightens towards the end. deadline is a time.monotonic() value;
+        TimeoutError is raised if it (or timeout) is reached first.
+        """
+        if timeout is not None:
+            end = time.monotonic() + timeout
+            deadline = end if deadline is None else min(deadline, end)
+
+        predicted = [t for a, t in self._predicted_end.items() if axis in (None, a)]
+        if predict and predicted:
+            now = time.monotonic()
+            # Wake up with 10% of the move (at least 20 ms) still to go
+            wake = max(predicted) - max(0.1 * (max(predicted) - now), 0.02)
+            if deadline is not None:
+                wake = min(wake, deadline)
+            if wake > now:
+                time.sleep(wake - now)
+
+        interval = min_interval
+        while True:
+            if any(axis is None or a == axis for a in self._targets):
+                snapshot = self.get_snapshot(fresh=True)
+                moving, position = snapshot.axes_moving, snapshot.position
+            else:
+                moving, position = self.get_is_moving(), None
+            axes = [a for a, m in moving.items() if m and axis in (None, a)]
+            if not axes:
+                return
+
+            remaining = None
+            if position is not None:
+                remaining = estimate_remaining(
+                    axes, position, self._targets, self._velocities
+                )
+            interval = poll_interval(interval, remaining, min_interval, max_interval)
+
+            now = time.monotonic()
+            if deadline is not None:
+                if now >= deadline:
+                    raise TimeoutError(f"Stage still moving on axes {axes}")
+                interval = min(interval, deadline - now)
+            time.sleep(interval)
+
+    def wait_for_axis(self, axis: int, timeout: float = None, **kwargs) -> None:
+        self.wait_for_move(axis=axis, timeout=timeout, **kwargs)
 
     def send_move(self, axis: int, position: float) -> None:
-        cmd = f"WT50\n{axis}PA{position}\n"
-        self.stop(axis)
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+        with self.frame() as f:
+            f.stop(axis).wait(50).move(axis, position)
 
     def send_velocity(self, axis: int, velocity: float) -> None:
-        cmd = f"{axis}VA{velocity}\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+        with self.frame() as f:
+            f.velocity(axis, velocity)
 
     def send_move_indefinite(self, axis: int, dir: str) -> None:
+        with self.frame() as f:
+            f.move_indefinite(axis, dir)
+
+    def send_jog(self, axis: int, velocity: float, dir: str) -> None:
         if not ((dir == "+") or (dir == "-")):
             return
-        cmd = f"{axis}MV{dir}\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+        with self.frame() as f:
+            f.velocity(axis, velocity).move_indefinite(axis, dir)
 
-    def send_move_wait(self, axis: int, position: float) -> None:
+    def send_move_wait(self, axis: int, position: float, timeout: float = None) -> None:
         self.send_move(axis, position)
-        self.wait_for_move()
+        self.wait_for_move(timeout=timeout)
 
     def send_enable_axis(self, axis: int) -> None:
-        cmd = f"{axis}MO\n"
-        with self._serial_mutex:
-            self._serial.write(bytes(cmd, "utf-8"))
+        with self.frame() as f:
+            f.enable_axis(axis)
+
+    @staticmethod
+    def compile_program(moves: list, dwell: int = 0) -> list:
+        """Turn a move list into the body of an ESP stored program.
+
+        Each move is a dict of axis -> absolute position. All axes of a move
+        start together, the program waits for them to stop (WS) and then
+        dwells for dwell ms before the next move.
+        """
+        commands = []
+        for move in moves:
+            for axis, position in move.items():
+                commands.append((axis, "PA", float(position)))
+            for axis in move:
+                commands.append((axis, "WS", None))
+            if dwell > 0:
+                commands.append((None, "WT", dwell))
+        return commands
+
+    def _write_uncached(self, payload: bytes) -> None:
+        # For commands whose effect on VA/MV state the cache can't follow
+        with self._write_mutex:
+            try:
+                self._serial.write(payload)
+            finally:
+                self._invalidate_command_cache()
+
+    def upload_program(self, moves: list, dwell: int = 0) -> int:
+        """Store a move list on the controller, returning its program number.
+
+        Programs are cached by content, so an identical move list is only
+        uploaded once per session.
+        """
+        body = b"".join(encode_command(*c) for c in self.compile_program(moves, dwell))
+        key = hashlib.sha1(body).hexdigest()
+        if key in self._programs:
+            self._programs.move_to_end(key)
+            return self._programs[key]
+
+        if len(self._programs) < len(self._PROGRAM_SLOTS):
+            number = self._PROGRAM_SLOTS[len(self._programs)]
+        else:
+            _, number = self._programs.popitem(last=False)
+
+        payload = (
+            encode_command(number, "XX")
+            + encode_command(number, "EP")
+            + body
+            + encode_command(None, "QP")
+        )
+        self._post(self._write_uncached, payload)
+        self._programs[key] = number
+        return number
+
+    def run_program(
+        self, moves: list, dwell: int = 0, wait: bool = True, timeout: float = None
+    ) -> int:
+        number = self.upload_program(moves, dwell)
+        self._post(self._write_uncached, encode_command(number, "EX"))
+        if wait:
+            self.wait_for_program(idle=dwell / 1000 + 0.1, timeout=timeout)
+        return number
+
+    def wait_for_program(self, idle: float = 0.1, timeout: float = None) -> None:
+        """Wait until the stage has not moved for idle seconds.
+
+        TS only reports motion, so a program is taken to be finished once
+        the axes have stayed still for longer than its dwells.
+        """
+        start = last_moving = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if self.is_moving():
+                last_moving = now
+            elif now - last_moving >= idle:
+                return
+            if timeout is not None and now - start >= timeout:
+                raise TimeoutError("Stored program still running")
+            time.sleep(min(idle / 4, 0.05))
 
     def status(self) -> dict:
+        rv = self.query_status(errors=True)
         return {
-            "position": self.get_current_position(),
-            "axes_moving": self.get_is_moving(),
-            "stage_active_flag": self.is_moving(),
+            "position": rv.position,
+            "axes_moving": rv.axes_moving,
+            "stage_active_flag": any(rv.axes_moving.values()),
+            "error": (rv.error_code, rv.error_message),
         }
 
 
-class TriggerControl:
-    def __init__(self, serial_name: str, serial_baud: int, timeout: int):
-        self._serial = serial.Serial(serial_name, serial_baud, timeout=timeout)
-        self._serial_mutex = threading.Lock()
+def coordinated_move(
+    channel_map: dict,
+    targets: dict,
+    wait: bool = True,
+    timeout: float = None,
+    tolerance: float = 1e-3,
+    min_interval: float = 0.005,
+    max_interval: float = 0.1,
+) -> dict:
+    """Move several logical channels at once and wait for all of them.
+
+    channel_map maps channel -> (stage, axis) as in the run scripts and
+    targets maps channel -> position. Each controller gets one frame and all
+    of them are polled together. Returns channel -> seconds from dispatch
+    until that axis was seen stopped on target. Raises RuntimeError if an
+    axis stops more than tolerance away from its target (dropped move,
+    limit, controller error).
+    """
+    by_stage = {}
+    for channel, position in targets.items():
+        stage, axis = channel_map[channel]
+        by_stage.setdefault(stage, {})[channel] = (axis, float(position))
+
+    for stage, moves in by_stage.items():
+        frame = stage.frame()
+        for axis, _ in moves.values():
+            frame.stop(axis)
+        frame.wait(50)
+        for axis, position in moves.values():
+            frame.move(axis, position)
+        frame.send()
+    start = time.monotonic()
+    if not wait:
+        return {}
+
+    completed = {}
+    interval = min_interval
+    while True:
+        now = time.monotonic()
+        pending = {
+            stage: {c: m for c, m in moves.items() if c not in completed}
+            for stage, moves in by_stage.items()
+        }
+        # Queries to every controller go out before any reply is awaited
+        futures = {
+            stage: stage.submit_query(status_queries(stage._AXES))
+            for stage, moves in pending.items()
+            if len(moves) > 0
+        }
+
+        remaining = 0.0
+        off_target = {}
+        for stage, future in futures.items():
+            snapshot = parse_status(stage._AXES, split_reply(future.result()))
+            for channel, (axis, position) in pending[stage].items():
+                if snapshot.axes_moving[axis]:
+                    continue
+                if abs(snapshot.position[axis] - position) <= tolerance:
+                    completed[channel] = now - start
+                elif now - start > 0.25:
+                    # Before this the axis may just not have left the WT50 yet
+                    off_target[channel] = (snapshot.position[axis], position)
+
+            axes = [a for c, (a, _) in pending[stage].items() if c not in completed]
+            estimate = estimate_remaining(
+                axes, snapshot.position, stage._targets, stage._velocities
+            )
+            if estimate is None or remaining is None:
+                remaining = None
+            else:
+                remaining = max(remaining, estimate)
+
+        if off_target:
+            stopped = ", ".join(
+                f"{c} at {p} (target {t})" for c, (p, t) in off_target.items()
+            )
+            raise RuntimeError(f"Channels stopped short of their targets: {stopped}")
+        if len(completed) == len(targets):
+            return completed
+        interval = poll_interval(interval, remaining, min_interval, max_interval)
+        if timeout is not None:
+            if now - start >= timeout:
+                moving = [c for c in targets if c not in completed]
+                raise TimeoutError(f"Channels {moving} still moving")
+            interval = min(interval, start + timeout - now)
+        time.sleep(interval)
+
 
+def emergency_stop_all(stages: list) -> None:
+    """Abort every stage at once rather than one port after another."""
+    threads = [threading.Thread(target=stage.emergency_stop) for stage in stages]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+class ESP302StageControl(ESPStageControl):
+    _HOME_ALL_AXIS = None
+
+
+class ESP300StageControl(ESPStageControl):
+    _HOME_ALL_AXIS = 0
+
+
+class TriggerControl(SerialDevice):
     def is_done(self):
         while True:
             print("wait")
-            rv = self._serial.readline().strip()
+            rv = self._readline()
             if len(rv) > 0:
                 print("done")
                 return rv == b"D"
 
-    def send_trigger(self, channel=None, frames=1000, stage=True, notify=False):
-        print("here")
+    def _write_wait_done(self, payload: bytes, on_sent=None):
+        self._write(payload)
+        if on_sent is not None:
+            on_sent(time.monotonic())
+        return self.is_done()
+
+    @staticmethod
+    def encode_trigger(channel=None, frames=1000, stage=True, notify=False) -> bytes:
         payload = b"T"
 
         # Specify the channel
@@ -218,71 +1199,332 @@ class TriggerControl:
         payload += b"Y" if notify else b"N"
         payload += bytes(str(frames), "utf-8")
         payload += b"\r"
+        return payload
+
+    def send_trigger(
+        self,
+        channel=None,
+        frames=1000,
+        stage=True,
+        notify=False,
+        wait=True,
+        on_sent=None,
+    ):
+        """on_sent, if given, is called with time.monotonic() once written."""
+        print("here")
+        payload = self.encode_trigger(channel, frames, stage, notify)
+
+        if not wait:
+            return self.submit(self._write_wait_done, payload, on_sent)
+        return self._run(self._write_wait_done, payload, on_sent)
+
+
+TABLE_CACHE_FILE = "wavetable_cache.json"
+DEFAULT_AOTF_TABLE = GatingTable.from_spec("off:150,on:2304,off:100")
+_table_cache_mutex = threading.Lock()
+
+
+def _read_table_cache(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_table_cache(path: str, device: str, hashes: dict) -> None:
+    # All DACs share one file, so the read-modify-write is done under a lock
+    with _table_cache_mutex:
+        cache = _read_table_cache(path)
+        cache[device] = hashes
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, path)
+
+
+DEFAULT_CHUNK_SIZE = 512
+
+
+def iter_chunks(payload, chunk_size: int):
+    view = memoryview(payload)
+    for i in range(0, len(view), chunk_size):
+        yield view[i : i + chunk_size]
+
+
+class TableUpload:
+    """Progress of a streaming table upload started by DACControl.stream_table."""
+
+    def __init__(self, total: int = None, progress=None):
+        self.total = total
+        self.sent = 0
+        self.chunks = 0
+        self.state = "pending"
+        self.done = None
+        self.error = None
+        self.progress = progress
+        self.future = None
+        self._started = None
+        self._written = None
+        self._finished = None
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def result(self, timeout: float = None):
+        return self.future.result(timeout)
+
+    @staticmethod
+    def _rate(sent: int, start: float, end: float):
+        if start is None or end is None or end <= start:
+            return None
+        return sent / (end - start)
+
+    def report(self) -> dict:
+        now = time.monotonic()
+        running = self._finished is None
+        return {
+            "state": self.state,
+            "done": self.done,
+            "error": self.error,
+            "sent": self.sent,
+            "total": self.total,
+            "chunks": self.chunks,
+            # Rate at which the port accepted data, and including the Pico's reply
+            "write_bytes_per_s": self._rate(
+                self.sent, self._started, now if running else self._written
+            ),
+            "bytes_per_s": self._rate(
+                self.sent, self._started, now if running else self._finished
+            ),
+        }
 
-        with self._serial_mutex:
-            self._serial.write(payload)
-            return self.is_done()
 
+class DACControl(SerialDevice):
+    """Galvo DAC and AOTF gating tables on a Pico.
+
+    The hash of the last table of each kind that the Pico acknowledged is
+    kept in cache_file. An upload whose bytes match is skipped. reset()
+    forgets the hashes. A Pico that was power-cycled still holds its
+    defaults, so after one either call reset() or pass force=True.
+    """
 
-class DACControl:
     def __init__(
-        self, serial_name: str, serial_baud: int, timeout: int, default_table=""
+        self,
+        serial_name: str,
+        serial_baud: int,
+        timeout: int,
+        default_table="",
+        threaded=False,
+        cache_file=TABLE_CACHE_FILE,
     ):
-        self._serial = serial.Serial(serial_name, serial_baud, timeout=timeout)
-        self._serial_mutex = threading.Lock()
+        SerialDevice.__init__(self, serial_name, serial_baud, timeout, threaded)
         self.default_table = default_table
-        self.DAC_table = []
-        self.AOTF_table = []
+        self.DAC_table = Wavetable((), byte_depth=2, key=b"S")
+        self.AOTF_table = Wavetable((), byte_depth=1, key=b"A")
+
+        self.serial_name = serial_name
+        self.cache_file = cache_file
+        self._sent_hashes = {}
+        if cache_file is not None:
+            self._sent_hashes = _read_table_cache(cache_file).get(serial_name, {})
+        self.skipped_uploads = 0
+        self.last_upload = None
 
     @staticmethod
-    def load_table(raw):
-        raw = raw.strip().split(b",")
-        return [int(x, 16) for x in raw]
+    def load_table(raw) -> Wavetable:
+        return Wavetable.from_hex(raw, byte_depth=2, key=b"S")
 
     def is_done(self):
         while True:
-            rv = self._serial.readline().strip()
+            rv = self._readline()
             if len(rv) > 0:
                 return rv == b"D"
 
-    def send_table(self, wavetable, key=b"S", byte_depth=2):
-        payload = key + b"".join(
-            map(lambda x: x.to_bytes(byte_depth, "little"), wavetable)
-        )
-        with self._serial_mutex:
-            sent = self._serial.write(payload)
-            print(f"Sent {sent} bytes")
-            return self.is_done()
+    def _write_wait_done(self, payload: bytes):
+        sent = self._write_buffer(payload)
+        print(f"Sent {sent} bytes")
+        return self.is_done()
 
-    def send_wavetable(self):
-        return self.send_table(self.DAC_table, key=b"S", byte_depth=2)
+    @staticmethod
+    def encode_table(wavetable, key=b"S", byte_depth=2) -> bytes:
+        if not isinstance(wavetable, Wavetable):
+            wavetable = Wavetable(wavetable, byte_depth, key)
+        elif wavetable.key != key or wavetable.byte_depth != byte_depth:
+            wavetable = Wavetable(wavetable.tolist(), byte_depth, key)
+        return wavetable.encode()
 
-    def send_AOTF_table(self):
-        return self.send_table(self.AOTF_table, key=b"A", byte_depth=1)
+    @staticmethod
+    def table_hash(payload: bytes) -> str:
+        return hashlib.sha1(payload).hexdigest()
 
-    def reset(self):
-        with self._serial_mutex:
-            self._serial.write(b"R")
-            done = self.is_done()
+    def is_loaded(self, payload: bytes) -> bool:
+        """True if the Pico last acknowledged exactly this payload."""
+        key = bytes(payload[:1]).decode()
+        return self._sent_hashes.get(key) == self.table_hash(payload)
 
+    def _save_hashes(self) -> None:
+        if self.cache_file is not None:
+            _update_table_cache(self.cache_file, self.serial_name, self._sent_hashes)
+
+    def _upload(self, payload: bytes, force=False):
+        key = bytes(payload[:1]).decode()
+        # Checked here on the I/O thread, so a reset() or another upload
+        # queued ahead of this one can't change the answer
+        if not force and self.is_loaded(payload):
+            self.skipped_uploads += 1
+            print(f"Table {key} unchanged, skipping upload")
             return True
+        # Whatever was loaded before is gone once the upload starts. Persist
+        # that first, so a crash mid-upload can't leave a stale hash on disk
+        self._sent_hashes.pop(key, None)
+        self._save_hashes()
+        done = self._write_wait_done(payload)
+        if done:
+            self._sent_hashes[key] = self.table_hash(payload)
+            self._save_hashes()
+        return done
 
-    def load_defaults(self):
-        print("Performing reset...")
-        self.reset()
+    def _stream(self, upload: TableUpload, chunks, payload=None) -> bool:
+        if payload is not None and self.is_loaded(payload):
+            self.skipped_uploads += 1
+            upload.state = "skipped"
+            upload.done = True
+            return True
+        upload.state = "running"
+        upload._started = time.monotonic()
+        digest = hashlib.sha1()
+        key = None
+        try:
+            for chunk in chunks:
+                if upload._cancel.is_set():
+                    # The Pico is left part way through a table; reset() it
+                    upload.state = "cancelled"
+                    return False
+                if key is None:
+                    key = bytes(chunk[:1]).decode()
+                    self._sent_hashes.pop(key, None)
+                    self._save_hashes()
+                digest.update(chunk)
+                upload.sent += self._write_buffer(chunk)
+                upload.chunks += 1
+                if upload.progress is not None:
+                    upload.progress(upload)
+            upload._written = time.monotonic()
+
+            upload.done = self.is_done()
+            upload.state = "done"
+            if upload.done and key is not None:
+                self._sent_hashes[key] = digest.hexdigest()
+            return upload.done
+        except Exception as e:
+            upload.error = str(e)
+            upload.state = "failed"
+            raise
+        finally:
+            upload._finished = time.monotonic()
+            self._save_hashes()
+            self.last_upload = upload
+
+    def stream_table(
+        self,
+        source,
+        key=b"S",
+        byte_depth=2,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        progress=None,
+        force=False,
+    ) -> TableUpload:
+        """Upload a table in chunks on the I/O thread and return at once.
+
+        source is a Wavetable, a list of samples, an encoded payload, or an
+        iterable of already encoded chunks (key byte first). progress, if
+        given, is called with the TableUpload after every chunk. Call
+        result() on the returned upload to wait for the Pico's reply.
+        """
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            payload = source
+        elif isinstance(source, (Wavetable, list, tuple)):
+            payload = self.encode_table(source, key, byte_depth)
+        else:
+            payload = None
 
+        if payload is None:
+            upload = TableUpload(None, progress)
+            chunks = source
+        else:
+            upload = TableUpload(len(payload), progress)
+            chunks = iter_chunks(payload, chunk_size)
+
+        # The upload is skipped by _stream if the Pico already has payload
+        skip_if_loaded = None if force else payload
+        upload.future = self.submit(self._stream, upload, chunks, skip_if_loaded)
+        return upload
+
+    def send_table(self, wavetable, key=b"S", byte_depth=2, wait=True, force=False):
+        payload = self.encode_table(wavetable, key, byte_depth)
+        if not wait:
+            return self.submit(self._upload, payload, force)
+        return self._run(self._upload, payload, force)
+
+    def send_wavetable(self, force=False):
+        return self.send_table(self.DAC_table, key=b"S", byte_depth=2, force=force)
+
+    def send_AOTF_table(self, force=False):
+        return self.send_table(self.AOTF_table, key=b"A", byte_depth=1, force=force)
+
+    def _reset(self):
+        # Forget the hashes on the I/O thread, so an upload queued after the
+        # reset sees them cleared and one queued before it can't restore them
+        self._sent_hashes = {}
+        self._save_hashes()
+        self._write(b"R")
+        return self.is_done()
+
+    def reset(self):
+        self._run(self._reset)
+        return True
+
+    def load_defaults(self, force=False) -> dict:
+        """Load and upload the default tables; returns seconds per step."""
+        timings = {}
+        start = time.time()
         print(f"Loading DAC table from file... [{self.default_table}]")
-        with open(self.default_table, "rb") as f:
-            r = f.read()
-            self.DAC_table = self.load_table(r)
+        self.DAC_table = wavetables.load_file(self.default_table, 2, b"S")
+        self.AOTF_table = DEFAULT_AOTF_TABLE
+        timings["parse"] = time.time() - start
+
+        loaded = self.is_loaded(self.encode_table(self.DAC_table, b"S", 2))
+        loaded = loaded and self.is_loaded(self.encode_table(self.AOTF_table, b"A", 1))
+        if loaded and not force:
+            print("DAC and AOTF tables unchanged, skipping reset and upload")
+            self.skipped_uploads += 2
+            return timings
+
+        print("Performing reset...")
+        start = time.time()
+        self.reset()
+        timings["reset"] = time.time() - start
 
         print("Applying DAC function...")
         start = time.time()
         rv = self.send_wavetable()
-        print(f"\tFinished in {(time.time() - start)}s [{rv}]")
+        timings["dac"] = time.time() - start
+        print(f"\tFinished in {timings['dac']}s [{rv}]")
 
         print("Applying AOTF function...")
         start = time.time()
-        self.AOTF_table = ([0] * 150) + ([1] * 2304) + ([0] * 100)
         rv = self.send_AOTF_table()
-        print(f"\tFinished in {time.time() - start} [{rv}]")
+        timings["aotf"] = time.time() - start
+        print(f"\tFinished in {timings['aotf']} [{rv}]")
+        return timings
+
+    def io_stats(self) -> dict:
+        stats = SerialDevice.io_stats(self)
+        stats["skipped_uploads"] = self.skipped_uploads
+        if self.last_upload is not None:
+            stats["last_upload"] = self.last_upload.report()
+        return stats
@@ -0,0 +1,316 @@
+"""
+Tile-scan planning and execution.
+
+Tiles are (x, y) stage positions. Full grids are walked in serpentine
+order. Sparse tile sets (e.g. from an ROI mask) are ordered with a
+nearest-neighbour tour improved by 2-opt. Travel cost is the estimated
+move time, not the distance, because X and Y move at the same time. Move
+times come from the stages' calibrated motion models when they have them.
+"""
+
+import heapq
+import threading
+import time
+
+import stage_control
+from motion_model import AxisMotionModel
+
+DEFAULT_VELOCITY = 20.0
+DEFAULT_ACCELERATION = 80.0
+DEFAULT_SETTLE = 0.05
+
+
+def default_model() -> AxisMotionModel:
+    return AxisMotionModel(DEFAULT_VELOCITY, DEFAULT_ACCELERATION, DEFAULT_SETTLE)
+
+
+class TravelModel:
+    """Cost function for the planner: seconds to travel between two tiles."""
+
+    def __init__(self, x_model=None, y_model=None):
+        self.models = (
+            default_model() if x_model is None else x_model,
+            default_model() if y_model is None else y_model,
+        )
+
+    @classmethod
+    def for_channels(cls, channel_map: dict, x_channel, y_channel) -> "TravelModel":
+        models = []
+        for c in (x_channel, y_channel):
+            stage, axis = channel_map[c]
+            models.append(stage.motion_models.get(axis))
+        return cls(*models)
+
+    def __call__(self, a: tuple, b: tuple) -> float:
+        if a == b:
+            return 0.0
+        return max(self.models[i].move_time(b[i] - a[i]) for i in range(2))
+
+
+def grid_tiles(x0: float, y0: float, nx: int, ny: int, dx: float, dy: float) -> list:
+    return [(x0 + i * dx, y0 + j * dy) for j in range(ny) for i in range(nx)]
+
+
+def mask_tiles(mask: list, x0: float, y0: float, dx: float, dy: float) -> list:
+    """Tiles for every truthy cell of a row-major ROI mask."""
+    return [
+        (x0 + i * dx, y0 + j * dy)
+        for j, row in enumerate(mask)
+        for i, cell in enumerate(row)
+        if cell
+    ]
+
+
+def is_full_grid(tiles: list) -> bool:
+    xs = {x for x, _ in tiles}
+    ys = {y for _, y in tiles}
+    return len(set(tiles)) == len(tiles) == len(xs) * len(ys)
+
+
+def serpentine(tiles: list) -> list:
+    rows = {}
+    for x, y in tiles:
+        rows.setdefault(y, []).append(x)
+    order = []
+    for i, y in enumerate(sorted(rows)):
+        xs = sorted(rows[y], reverse=(i % 2 == 1))
+        order.extend((x, y) for x in xs)
+    return order
+
+
+def _spread(a: tuple, b: tuple) -> float:
+    # Larger of |dx| and |dy|: orders tiles like the move time of a pair of
+    # similar axes, at a fraction of the cost of evaluating the model
+    return max(abs(b[0] - a[0]), abs(b[1] - a[1]))
+
+
+def neighbour_lists(points: list, k: int) -> list:
+    """Indices of the k nearest points to each point.
+
+    Sweeps outwards through the points sorted by x, stopping once |dx|
+    alone is further than the k-th nearest point found so far.
+    """
+    by_x = sorted(range(len(points)), key=lambda i: points[i][0])
+    rank = {p: r for r, p in enumerate(by_x)}
+    lists = []
+    for a in range(len(points)):
+        ax = points[a][0]
+        best = []  # max-heap of (-spread, index)
+        for step in (-1, 1):
+            r = rank[a] + step
+            while 0 <= r < len(by_x):
+                b = by_x[r]
+                if len(best) == k and abs(points[b][0] - ax) > -best[0][0]:
+                    break
+                d = _spread(points[a], points[b])
+                if len(best) < k:
+                    heapq.heappush(best, (-d, b))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, b))
+                r += step
+        lists.append([b for _, b in sorted(best, reverse=True)])
+    return lists
+
+
+def nearest_neighbour(tiles: list, cost, start: tuple = None, neighbours: int = 8):
+    """Greedy tour. Each step costs only the closest few unvisited tiles."""
+    points = list(tiles) + ([start] if start is not None else [])
+    near = neighbour_lists(points, neighbours)
+    unvisited = set(range(len(tiles)))
+    current = len(tiles) if start is not None else 0
+    order = []
+    if start is None:
+        unvisited.discard(0)
+        order.append(points[0])
+    while unvisited:
+        candidates = [b for b in near[current] if b in unvisited]
+        if not candidates:
+            key = lambda b: _spread(points[current], points[b])
+            candidates = heapq.nsmallest(neighbours, unvisited, key=key)
+        current = min(candidates, key=lambda b: cost(points[current], points[b]))
+        unvisited.discard(current)
+        order.append(points[current])
+    return order
+
+
+def two_opt(
+    order: list,
+    cost,
+    start: tuple = None,
+    max_passes: int = 20,
+    neighbours: int = 8,
+    time_limit: float = 1.0,
+) -> list:
+    """Improve an open path by reversing segments while that shortens it.
+
+    Only reversals that join a tile to one of its nearest neighbours are
+    tried, so a pass is O(n * neighbours) cost evaluations instead of
+    O(n^2). The search also stops after time_limit seconds and returns the
+    best path so far.
+    """
+    points = ([start] if start is not None else []) + list(order)
+    fixed = 1 if start is not None else 0
+    n = len(points)
+    if n < 3:
+        return points[fixed:]
+    deadline = time.monotonic() + time_limit
+    near = neighbour_lists(points, neighbours)
+    path = list(range(n))  # indices into points, in visiting order
+    pos = list(range(n))  # position of each point in path
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            a = path[i - 1]
+            for c in near[a]:
+                j = pos[c]
+                if j <= i:
+                    continue
+                # Reversing path[i..j] replaces edge (a, path[i]) with (a, c)
+                before = cost(points[a], points[path[i]])
+                after = cost(points[a], points[c])
+                if j + 1 < n:
+                    before += cost(points[c], points[path[j + 1]])
+                    after += cost(points[path[i]], points[path[j + 1]])
+                if after < before - 1e-9:
+                    path[i : j + 1] = reversed(path[i : j + 1])
+                    for p in range(i, j + 1):
+                        pos[path[p]] = p
+                    improved = True
+                    break
+            if time.monotonic() > deadline:
+                return [points[p] for p in path[fixed:]]
+        if not improved:
+            break
+    return [points[p] for p in path[fixed:]]
+
+
+def plan_tiles(
+    tiles: list, cost=None, start: tuple = None, time_limit: float = 1.0
+) -> list:
+    cost = TravelModel() if cost is None else cost
+    if is_full_grid(tiles):
+        return serpentine(tiles)
+    order = nearest_neighbour(tiles, cost, start)
+    return two_opt(order, cost, start, time_limit=time_limit)
+
+
+def estimate_scan_time(
+    order: list, cost=None, acquire_time: float = 0.0, start: tuple = None
+) -> float:
+    cost = TravelModel() if cost is None else cost
+    path = ([start] if start is not None else []) + list(order)
+    travel = sum(cost(a, b) for a, b in zip(path, path[1:]))
+    return travel + acquire_time * len(order)
+
+
+class TileScanJob(threading.Thread):
+    """Moves to every tile in the planned order and triggers an acquisition."""
+
+    def __init__(
+        self,
+        channel_map: dict,
+        x_channel,
+        y_channel,
+        trigger,
+        tiles: list,
+        frames: int = 1,
+        channel=None,
+        cost=None,
+        acquire_time: float = 0.0,
+        move_timeout: float = 30.0,
+        tolerance: float = 1e-3,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.channel_map = channel_map
+        self.x_channel = x_channel
+        self.y_channel = y_channel
+        self.trigger = trigger
+        self.frames = frames
+        self.channel = channel
+        self.move_timeout = move_timeout
+        self.tolerance = tolerance
+        if cost is None:
+            cost = TravelModel.for_channels(channel_map, x_channel, y_channel)
+        self.cost = cost
+        self.tiles = list(tiles)
+        self.acquire_time = acquire_time
+
+        # Planned in run(), so starting a job doesn't wait for the planner
+        self.order = None
+        self.estimated_time = None
+
+        self.state = "pending"
+        self.error = None
+        self.timings = []
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def report(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "tiles_done": len(self.timings),
+            "tiles_total": len(self.tiles),
+            "estimated_time": self.estimated_time,
+            "timings": list(self.timings),
+        }
+
+    def run(self):
+        self.state = "planning"
+        try:
+            self.order = plan_tiles(self.tiles, self.cost)
+            self.estimated_time = estimate_scan_time(
+                self.order, self.cost, self.acquire_time
+            )
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+            return
+        print(
+            f"Tile scan: {len(self.order)} tiles, "
+            f"estimated {self.estimated_time:.1f}s"
+        )
+        self.state = "running"
+        start = time.monotonic()
+        try:
+            for i, (x, y) in enumerate(self.order):
+                if self._cancel.is_set():
+                    self.state = "cancelled"
+                    return
+
+                t0 = time.monotonic()
+                stage_control.coordinated_move(
+                    self.channel_map,
+                    {self.x_channel: x, self.y_channel: y},
+                    timeout=self.move_timeout,
+                    tolerance=self.tolerance,
+                )
+                t1 = time.monotonic()
+                done = self.trigger.send_trigger(
+                    channel=self.channel, frames=self.frames, stage=True
+                )
+                t2 = time.monotonic()
+
+                self.timings.append(
+                    {
+                        "tile": i,
+                        "position": (x, y),
+                        "move": t1 - t0,
+                        "trigger": t2 - t1,
+                        "done": done,
+                        "elapsed": t2 - start,
+                    }
+                )
+            self.state = "done"
+            print(
+                f"Tile scan finished in {time.monotonic() - start:.1f}s "
+                f"(estimated {self.estimated_time:.1f}s)"
+            )
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+            for c in (self.x_channel, self.y_channel):
+                stage, axis = self.channel_map[c]
+                stage.stop(axis)
@@ -0,0 +1,122 @@
+"""
+Parametric galvo waveforms for DACControl.
+
+Waveforms are described by amplitude (peak to peak, in DAC counts), offset
+(centre, in DAC counts), sample count and, where relevant, the fraction of
+the period spent on flyback. Results are memoized per parameter set, and
+each returned Wavetable caches its encoded payload. Regenerating a table
+that was already sent is therefore a dictionary lookup, and the resend is
+skipped by the DAC's upload cache.
+"""
+
+import functools
+
+from wavetables import Wavetable
+
+DAC_MAX = 0xFFFF
+
+
+def _to_table(values) -> Wavetable:
+    samples = [int(round(v)) for v in values]
+    low, high = min(samples), max(samples)
+    if low < 0 or high > DAC_MAX:
+        raise ValueError(
+            f"Waveform spans {low}..{high}, outside the DAC range 0..{DAC_MAX}"
+        )
+    return Wavetable(samples, byte_depth=2, key=b"S")
+
+
+def _check(samples: int, flyback: float = 0.0) -> None:
+    if samples < 2:
+        raise ValueError("A waveform needs at least 2 samples")
+    if not 0.0 <= flyback < 1.0:
+        raise ValueError("Flyback fraction must be in [0, 1)")
+    if split(samples, flyback)[0] < 2:
+        raise ValueError(
+            f"Flyback {flyback} leaves fewer than 2 active samples out of {samples}"
+        )
+
+
+def _ramp(start: float, stop: float, n: int, endpoint: bool) -> list:
+    step = (stop - start) / ((n - 1) if endpoint else n)
+    return [start + i * step for i in range(n)]
+
+
+def split(samples: int, flyback: float) -> tuple:
+    """(active, flyback) sample counts for a period."""
+    back = int(round(samples * flyback))
+    return samples - back, back
+
+
+@functools.lru_cache(maxsize=64)
+def sawtooth(
+    amplitude: float, offset: float, samples: int, flyback: float = 0.0
+) -> Wavetable:
+    """Linear ramp up, then a linear return over the flyback fraction."""
+    _check(samples, flyback)
+    low, high = offset - amplitude / 2, offset + amplitude / 2
+    active, back = split(samples, flyback)
+    if back == 0:
+        return _to_table(_ramp(low, high, samples, endpoint=True))
+    # Evenly spaced steps from high towards low; the next period's first
+    # sample is low itself, so it is not repeated at the end of this one
+    flyback_values = [high + (low - high) * i / (back + 1) for i in range(1, back + 1)]
+    return _to_table(_ramp(low, high, active, endpoint=True) + flyback_values)
+
+
+@functools.lru_cache(maxsize=64)
+def triangle(amplitude: float, offset: float, samples: int) -> Wavetable:
+    _check(samples)
+    low, high = offset - amplitude / 2, offset + amplitude / 2
+    up = samples - samples // 2
+    return _to_table(
+        _ramp(low, high, up, endpoint=False)
+        + _ramp(high, low, samples - up, endpoint=False)
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def line_scan(
+    amplitude: float, offset: float, samples: int, flyback: float = 0.1
+) -> Wavetable:
+    """Linear scan with a smooth, velocity-matched flyback.
+
+    The flyback is a cubic Hermite segment from the top of the ramp back
+    to its start. It leaves and rejoins the ramp at the scan velocity, so
+    the galvo sees no velocity step at either end. Like the hand-made
+    tables in galvo_tables/, it overshoots slightly past both ends of the
+    scan. The first (samples - flyback samples) points are the active,
+    linear part of the line.
+    """
+    _check(samples, flyback)
+    active, back = split(samples, flyback)
+    if back == 0:
+        return sawtooth(amplitude, offset, samples)
+
+    low, high = offset - amplitude / 2, offset + amplitude / 2
+    ramp = _ramp(low, high, active, endpoint=True)
+    # Scan velocity in counts per sample, expressed per unit of flyback time
+    slope = (high - low) / (active - 1) * (back + 1)
+
+    flyback_values = []
+    for i in range(1, back + 1):
+        t = i / (back + 1)
+        h00 = 2 * t**3 - 3 * t**2 + 1
+        h10 = t**3 - 2 * t**2 + t
+        h01 = -2 * t**3 + 3 * t**2
+        h11 = t**3 - t**2
+        flyback_values.append(h00 * high + h10 * slope + h01 * low + h11 * slope)
+    return _to_table(ramp + flyback_values)
+
+
+SHAPES = {"sawtooth": sawtooth, "triangle": triangle, "line_scan": line_scan}
+
+
+def generate(shape: str, amplitude: float, offset: float, samples: int, **kw):
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown waveform {shape!r}; expected one of {list(SHAPES)}")
+    return SHAPES[shape](float(amplitude), float(offset), int(samples), **kw)
+
+
+def cache_info() -> dict:
+    return {name: fn.cache_info()._asdict() for name, fn in SHAPES.items()}
@@ -0,0 +1,287 @@
+"""
+Array-backed tables for the DAC Picos.
+
+Samples are held in an array.array: 'H' for the 16-bit galvo tables and
+'B' for the 8-bit AOTF gating tables. Parsing, range checks and packing to
+the little-endian wire format therefore run in C, not once per sample. The
+encoded payload is built once and reused for every resend.
+
+Tables can also be stored in a binary format (.wtb): a 16-byte header
+followed by the exact payload that is sent to the Pico, key byte first.
+The header holds the magic, format version, byte depth, key, sample count
+and CRC-32 of the payload. Binary tables are memory-mapped, and the mapped
+payload is handed to the serial write without copying. Convert the text
+tables with
+
+    python wavetables.py galvo_tables/*.txt
+"""
+
+import array
+import functools
+import mmap
+import re
+import struct
+import sys
+import zlib
+
+_TYPECODES = {1: "B", 2: "H"}
+
+# Upper bound on table length. The tables in use are ~2.5k samples; 64k
+# 16-bit samples is already half of the Pico's RAM. Lower this to the
+# firmware's buffer size if it is smaller.
+MAX_TABLE_SAMPLES = 65536
+
+MAGIC = b"WTBL"
+VERSION = 1
+_HEADER = struct.Struct("<4sBBcxII")  # magic, version, depth, key, count, crc32
+
+
+def _typecode(byte_depth: int) -> str:
+    if byte_depth not in _TYPECODES:
+        raise ValueError(f"Unsupported table byte depth {byte_depth}")
+    return _TYPECODES[byte_depth]
+
+
+class Wavetable:
+    """An immutable table of unsigned samples plus the key it is sent under."""
+
+    def __init__(self, samples=(), byte_depth: int = 2, key: bytes = b"S"):
+        self.key = key
+        self.byte_depth = byte_depth
+        self.max_value = (1 << (8 * byte_depth)) - 1
+        try:
+            self._samples = array.array(_typecode(byte_depth), samples)
+        except OverflowError:
+            raise ValueError(f"Table samples must be in 0..{self.max_value}")
+        self._payload = None
+
+    @classmethod
+    def from_array(cls, samples: array.array, key: bytes = b"S") -> "Wavetable":
+        table = cls((), samples.itemsize, key)
+        table._samples = samples
+        return table
+
+    @classmethod
+    def from_payload(cls, payload, byte_depth: int = 2) -> "Wavetable":
+        """Wrap an encoded payload (key byte + little-endian samples) as is."""
+        payload = memoryview(payload)
+        table = cls((), byte_depth, bytes(payload[:1]))
+        if sys.byteorder == "little" or byte_depth == 1:
+            table._samples = payload[1:].cast(_typecode(byte_depth))
+        else:
+            table._samples.frombytes(payload[1:])
+            table._samples.byteswap()
+        table._payload = payload
+        return table
+
+    @classmethod
+    def from_hex(cls, raw: bytes, byte_depth: int = 2, key: bytes = b"S"):
+        """Parse a comma separated hex table such as b"0x2a01,0x2a02,...".
+
+        Tables with fixed-width 0x-prefixed values, which is how every table
+        in galvo_tables/ is written, are decoded in one bytes.fromhex call.
+        Anything else falls back to parsing value by value.
+        """
+        raw = raw.strip()
+        count = raw.count(b",") + 1
+        width = 2 + 2 * byte_depth
+        stride = width + 1
+        fixed = (
+            len(raw) == count * stride - 1
+            and raw[width::stride] == b"," * (count - 1)
+            and raw[0::stride] == b"0" * count
+            and raw[1::stride].lower() == b"x" * count
+        )
+        if not fixed:
+            return cls((int(x, 16) for x in raw.split(b",")), byte_depth, key)
+
+        digits = raw.replace(b",", b"").replace(b"0x", b"").replace(b"0X", b"")
+        samples = array.array(_typecode(byte_depth))
+        samples.frombytes(bytes.fromhex(digits.decode("ascii")))
+        if len(samples) != count:
+            raise ValueError("Malformed hex table")
+        if sys.byteorder == "little":
+            samples.byteswap()  # hex digits are written most significant first
+        return cls.from_array(samples, key)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def __iter__(self):
+        return iter(self._samples)
+
+    def __getitem__(self, i):
+        return self._samples[i]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Wavetable):
+            return NotImplemented
+        return self.encode() == other.encode()
+
+    def __hash__(self) -> int:
+        return hash(self.encode())
+
+    def tolist(self) -> list:
+        return self._samples.tolist()
+
+    def encode(self) -> bytes:
+        """Key byte followed by the samples in little-endian order (memoized)."""
+        if self._payload is None:
+            samples = self._samples
+            if sys.byteorder == "big" and self.byte_depth > 1:
+                samples = array.array(samples.typecode, samples)
+                samples.byteswap()
+            self._payload = self.key + samples.tobytes()
+        return self._payload
+
+
+class GatingTable(Wavetable):
+    """AOTF gating table stored as run-length (value, count) segments.
+
+    Each segment is expanded into the wire buffer with a single bytes
+    multiplication, so building the default ~2.5k sample table is a handful
+    of C-level copies rather than a list of ints.
+    """
+
+    _NAMES = {"off": 0, "on": 1}
+
+    def __init__(self, segments, key: bytes = b"A"):
+        segments = tuple((int(v), int(n)) for v, n in segments)
+        for value, count in segments:
+            if not 0 <= value <= 0xFF or count < 0:
+                raise ValueError(f"Bad gating segment ({value}, {count})")
+        # Check before expanding, so a bad spec can't allocate gigabytes
+        total = sum(count for _, count in segments)
+        if total > MAX_TABLE_SAMPLES:
+            raise ValueError(
+                f"Gating table of {total} samples exceeds {MAX_TABLE_SAMPLES}"
+            )
+        Wavetable.__init__(self, (), byte_depth=1, key=key)
+        self.segments = segments
+        self._payload = key + b"".join(bytes((v,)) * n for v, n in segments)
+        self._samples = memoryview(self._payload)[1:]
+
+    @classmethod
+    def from_spec(cls, spec: str, key: bytes = b"A") -> "GatingTable":
+        """Parse a segment spec such as "off:150,on:2304,off:100".
+
+        Values are "on", "off" or an integer 0..255.
+        """
+        segments = []
+        for item in spec.strip().split(","):
+            try:
+                value, count = item.split(":")
+                value = value.strip().lower()
+                value = cls._NAMES[value] if value in cls._NAMES else int(value)
+                segments.append((value, int(count)))
+            except ValueError:
+                raise ValueError(f"Bad gating segment {item!r} in spec")
+        return cls(segments, key)
+
+    @classmethod
+    def from_flags(cls, raw: bytes, on: bytes = b"Y", key: bytes = b"A"):
+        """Gating table from one flag byte per sample, e.g. b"YYYNNNYY"."""
+        lookup = bytes(1 if i == on[0] else 0 for i in range(256))
+        flags = raw.strip().translate(lookup)
+        runs = re.finditer(rb"\x00+|\x01+", flags)
+        return cls(((flags[m.start()], m.end() - m.start()) for m in runs), key)
+
+    def spec(self) -> str:
+        names = {v: k for k, v in self._NAMES.items()}
+        return ",".join(f"{names.get(v, v)}:{n}" for v, n in self.segments)
+
+
+def _interpolate(samples: list, x: float, method: str) -> float:
+    n = len(samples)
+    if method == "nearest":
+        return samples[min(int(x + 0.5), n - 1)]
+    i = min(int(x), n - 2)
+    t = x - i
+    p1, p2 = samples[i], samples[i + 1]
+    if method == "linear":
+        return p1 + (p2 - p1) * t
+    # Catmull-Rom, with the end points repeated past either end of the table
+    p0 = samples[max(i - 1, 0)]
+    p3 = samples[min(i + 2, n - 1)]
+    return p1 + 0.5 * t * (
+        p2 - p0 + t * (2 * p0 - 5 * p1 + 4 * p2 - p3 + t * (3 * (p1 - p2) + p3 - p0))
+    )
+
+
+RESAMPLE_METHODS = ("nearest", "linear", "cubic")
+
+
+@functools.lru_cache(maxsize=32)
+def resample(table: Wavetable, length: int, method: str = "linear") -> Wavetable:
+    """Stretch or shrink a table to length samples, keeping both end points.
+
+    Cubic interpolation can overshoot, so results are clipped to the range
+    of the table's byte depth. Results are memoized, so switching back to
+    a line rate that was used before costs nothing.
+    """
+    if method not in RESAMPLE_METHODS:
+        raise ValueError(f"Unknown resample method {method!r}")
+    if length < 2 or len(table) < 2:
+        raise ValueError("Resampling needs at least 2 samples in and out")
+    if length > MAX_TABLE_SAMPLES:
+        raise ValueError(f"Tables are limited to {MAX_TABLE_SAMPLES} samples")
+
+    samples = table.tolist()
+    scale = (len(samples) - 1) / (length - 1)
+    top = table.max_value
+    values = (_interpolate(samples, i * scale, method) for i in range(length))
+    return Wavetable(
+        [min(max(int(round(v)), 0), top) for v in values], table.byte_depth, table.key
+    )
+
+
+def save_binary(table: Wavetable, path: str) -> None:
+    payload = table.encode()
+    header = _HEADER.pack(
+        MAGIC, VERSION, table.byte_depth, table.key, len(table), zlib.crc32(payload)
+    )
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(payload)
+
+
+def load_binary(path: str) -> Wavetable:
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < _HEADER.size:
+        raise ValueError(f"{path} is too short to be a binary table")
+    magic, version, byte_depth, key, count, crc = _HEADER.unpack_from(mapped)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} binary table")
+
+    payload = memoryview(mapped)[_HEADER.size :]
+    if len(payload) != 1 + count * byte_depth or payload[:1] != key:
+        raise ValueError(f"{path} is truncated or has a bad header")
+    if zlib.crc32(payload) != crc:
+        raise ValueError(f"{path} failed its checksum")
+    return Wavetable.from_payload(payload, byte_depth)
+
+
+def load_file(path: str, byte_depth: int = 2, key: bytes = b"S") -> Wavetable:
+    """Load a binary table, or a hex text table if the file has no magic."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            return load_binary(path)
+        f.seek(0)
+        return Wavetable.from_hex(f.read(), byte_depth, key)
+
+
+def convert_text_table(
+    src: str, dst: str = None, byte_depth: int = 2, key: bytes = b"S"
+) -> str:
+    if dst is None:
+        dst = src.rsplit(".", 1)[0] + ".wtb"
+    with open(src, "rb") as f:
+        table = Wavetable.from_hex(f.read(), byte_depth, key)
+    save_binary(table, dst)
+    return dst
+
+
+if __name__ == "__main__":
+    for src in sys.argv[1:]:
+        print(f"{src} -> {convert_text_table(src)}")
@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+def plane_positions(start: float, stop: float, step: float) -> list:
+    """Positions from start to stop (inclusive) in steps of |step|."""
+    if step == 0:
+        raise ValueError("Z-stack step must be non-zero")
+    step = abs(step) if stop >= start else -abs(step)
+    count = int(round((stop - start) / step)) + 1
+    return [start + i * step for i in range(count)]
+
+
+class ZStackJob(threading.Thread):
+    """Runs a z-stack on the server: move, settle and trigger for every plane.
+
+    The next move is sent the moment the trigger controller reports the
+    previous plane done, and settle detection uses the stage's adaptive
+    wait, so there is no client round trip between planes. Progress and
+    per-plane timings are available from report() while the job runs.
+    """
+
+    def __init__(
+        self,
+        stage,
+        axis: int,
+        trigger,
+        start: float,
+        stop: float,
+        step: float,
+        frames: int = 1,
+        channel=None,
+        settle_time: float = 0.0,
+        move_timeout: float = 10.0,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.stage = stage
+        self.axis = axis
+        self.trigger = trigger
+        self.positions = plane_positions(start, stop, step)
+        self.frames = frames
+        self.channel = channel
+        self.settle_time = settle_time
+        self.move_timeout = move_timeout
+
+        self.state = "pending"
+        self.error = None
+        self.timings = []
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def _move(self, position: float) -> None:
+        # The axis is already stopped here, so send_move's ST/WT50 is not needed
+        self.stage.frame().move(self.axis, position).send()
+
+    def report(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "planes_done": len(self.timings),
+            "planes_total": len(self.positions),
+            "timings": list(self.timings),
+        }
+
+    def run(self):
+        self.state = "running"
+        start = time.monotonic()
+        try:
+            self.stage.send_move(self.axis, self.positions[0])
+            for i, position in enumerate(self.positions):
+                if self._cancel.is_set():
+                    self.state = "cancelled"
+                    return
+
+                t0 = time.monotonic()
+                self.stage.wait_for_axis(self.axis, timeout=self.move_timeout)
+                if self.settle_time > 0:
+                    time.sleep(self.settle_time)
+                t1 = time.monotonic()
+
+                done = self.trigger.send_trigger(
+                    channel=self.channel, frames=self.frames, stage=True
+                )
+                t2 = time.monotonic()
+                if i + 1 < len(self.positions):
+                    self._move(self.positions[i + 1])
+
+                self.timings.append(
+                    {
+                        "plane": i,
+                        "position": position,
+                        "move": t1 - t0,
+                        "trigger": t2 - t1,
+                        "done": done,
+                        "elapsed": t2 - start,
+                    }
+                )
+            self.state = "done"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+            self.stage.stop(self.axis)